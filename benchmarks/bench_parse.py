@@ -0,0 +1,286 @@
+"""Parser throughput benchmark.
+
+Generates realistic request shapes and parses them with FieldStorage,
+cgi.parse and cgi.parse_multipart, reporting MB/s, fields/s and memory
+allocated while parsing (the tracemalloc peak and what stays allocated
+afterwards):
+
+    python -m benchmarks.bench_parse
+    python -m benchmarks.bench_parse --scale 0.01 --json > before.json
+    python -m benchmarks.bench_parse --scale 0.01 --compare before.json
+
+The workloads are a large GET query string, a urlencoded body with 10k
+fields, a multipart body with 10k small fields, a few 1 GB file parts,
+binary data without newlines, data made of very short lines and nested
+multipart/mixed parts.  --scale multiplies every size and field count;
+allocations are not traced for bodies larger than --alloc-limit bytes,
+since tracemalloc would dominate the run.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import cgi
+
+
+BOUNDARY = b'----benchmark-boundary'
+INNER = b'----benchmark-inner'
+CHUNK = 1 << 20
+GB = 1 << 30
+
+
+def repeat(pattern, size):
+    """Yield size bytes of pattern, in chunks of about CHUNK bytes."""
+    block = pattern * max(1, CHUNK // len(pattern))
+    while size > 0:
+        yield block[:size]
+        size -= len(block)
+
+
+def field_part(name, value, boundary=BOUNDARY):
+    return (b'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+            b'%s\r\n' % (boundary, name.encode(), value))
+
+
+def file_part(name, filename, size, pattern, boundary=BOUNDARY,
+              disposition=b'form-data'):
+    yield (b'--%s\r\nContent-Disposition: %s; name="%s"; filename="%s"'
+           b'\r\nContent-Type: application/octet-stream\r\n\r\n'
+           % (boundary, disposition, name.encode(), filename.encode()))
+    yield from repeat(pattern, size)
+    yield b'\r\n'
+
+
+def multipart(parts):
+    yield from parts
+    yield b'--%s--\r\n' % BOUNDARY
+
+
+def gen_get_query(scale):
+    fields = max(1, int(20000 * scale))
+    qs = '&'.join('key%d=value+%d%%21' % (i, i) for i in range(fields))
+    return 'GET', None, qs, [qs.encode()], fields
+
+
+def gen_urlencoded(scale):
+    fields = max(1, int(10000 * scale))
+    body = '&'.join('field%d=some+value+%d' % (i, i) for i in range(fields))
+    return ('POST', 'application/x-www-form-urlencoded', '', [body.encode()],
+            fields)
+
+
+def gen_multipart_fields(scale):
+    fields = max(1, int(10000 * scale))
+    parts = (field_part('field%d' % i, b'value %d' % i) for i in range(fields))
+    return 'POST', None, '', multipart(parts), fields
+
+
+def gen_file_parts(scale):
+    size = max(1, int(GB * scale))
+    line = b'0123456789abcdef' * 4 + b'\r\n'
+    parts = (chunk for i in range(3)
+             for chunk in file_part('file%d' % i, 'big%d.txt' % i, size, line))
+    return 'POST', None, '', multipart(parts), 3
+
+
+def gen_binary(scale):
+    size = max(1, int(64 * (1 << 20) * scale))
+    data = bytes(b for b in range(256) if b not in b'\r\n')
+    return ('POST', None, '', multipart(file_part('blob', 'blob.bin', size,
+                                                  data)), 1)
+
+
+def gen_short_lines(scale):
+    size = max(1, int(16 * (1 << 20) * scale))
+    return ('POST', None, '', multipart(file_part('lines', 'lines.txt', size,
+                                                  b'x\n')), 1)
+
+
+def gen_nested_mixed(scale):
+    groups = max(1, int(100 * scale))
+    per_group = 20
+
+    def parts():
+        for g in range(groups):
+            yield (b'--%s\r\nContent-Disposition: form-data; name="group%d"'
+                   b'\r\nContent-Type: multipart/mixed; boundary=%s\r\n\r\n'
+                   % (BOUNDARY, g, INNER))
+            for f in range(per_group):
+                yield from file_part('f%d' % f, 'file%d.txt' % f, 4096,
+                                     b'nested line\r\n', boundary=INNER,
+                                     disposition=b'file')
+            yield b'--%s--\r\n' % INNER
+    return 'POST', None, '', multipart(parts()), groups * per_group
+
+
+WORKLOADS = {
+    'get_query': (gen_get_query, ('FieldStorage', 'parse')),
+    'urlencoded_10k': (gen_urlencoded, ('FieldStorage', 'parse')),
+    'multipart_10k': (gen_multipart_fields, ('FieldStorage', 'parse_multipart')),
+    'file_parts_1g': (gen_file_parts, ('FieldStorage',)),
+    'binary_no_newlines': (gen_binary, ('FieldStorage', 'parse_multipart')),
+    'short_lines': (gen_short_lines, ('FieldStorage', 'parse_multipart')),
+    'nested_mixed': (gen_nested_mixed, ('FieldStorage',)),
+}
+
+
+class Request:
+    """A generated request body, kept in memory or in a temporary file."""
+
+    def __init__(self, method, ctype, qs, chunks, fields, spool_limit):
+        self.fields = fields
+        self.method = method
+        self.qs = qs
+        self.ctype = ctype or ('multipart/form-data; boundary=%s'
+                               % BOUNDARY.decode())
+        body = BytesIO()
+        for chunk in chunks:
+            body.write(chunk)
+            if body.tell() > spool_limit and isinstance(body, BytesIO):
+                spool = tempfile.TemporaryFile()
+                spool.write(body.getbuffer())
+                body = spool
+        self.size = body.tell()
+        self.body = body
+
+    def environ(self):
+        environ = {'REQUEST_METHOD': self.method, 'QUERY_STRING': self.qs}
+        if self.method != 'GET':
+            environ['CONTENT_TYPE'] = self.ctype
+            environ['CONTENT_LENGTH'] = str(self.size)
+        return environ
+
+    def fp(self):
+        self.body.seek(0)
+        return self.body
+
+    def close(self):
+        self.body.close()
+
+
+def count_fields(form):
+    if form.list is None:
+        return 1
+    return sum(count_fields(item) for item in form.list)
+
+
+def run_api(api, request):
+    config = cgi.ParserConfig()
+    environ = request.environ()
+    if api == 'FieldStorage':
+        with cgi.FieldStorage(request.fp(), environ=environ,
+                              config=config) as form:
+            if request.method == 'GET':
+                return len(form.list)
+            return count_fields(form)
+    if api == 'parse':
+        return len(cgi.parse(request.fp(), environ, config=config))
+    ctype, pdict = cgi.parse_header(environ['CONTENT_TYPE'])
+    pdict['boundary'] = pdict['boundary'].encode()
+    pdict['CONTENT-LENGTH'] = environ['CONTENT_LENGTH']
+    return sum(map(len, cgi.parse_multipart(request.fp(), pdict).values()))
+
+
+def measure(api, request, repeats, alloc_limit):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run_api(api, request)
+        times.append(time.perf_counter() - start)
+    seconds = statistics.median(times)
+    result = {'bytes': request.size, 'fields': request.fields,
+              'seconds': seconds,
+              'mb_per_s': request.size / seconds / 1e6,
+              'fields_per_s': request.fields / seconds,
+              'alloc_peak_bytes': None, 'alloc_retained_bytes': None}
+    if request.size <= alloc_limit:
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            run_api(api, request)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result['alloc_peak_bytes'] = peak - before
+        result['alloc_retained_bytes'] = current - before
+    return result
+
+
+def run(names, scale, repeats, alloc_limit, spool_limit):
+    results = {}
+    for name in names:
+        generate, apis = WORKLOADS[name]
+        request = Request(*generate(scale), spool_limit=spool_limit)
+        try:
+            for api in apis:
+                results['%s/%s' % (name, api)] = measure(api, request,
+                                                         repeats, alloc_limit)
+        finally:
+            request.close()
+    return results
+
+
+def report(results, baseline=None):
+    print('%-36s %10s %12s %12s  %s' % ('', 'MB/s', 'fields/s',
+                                        'peak KiB', 'vs baseline'
+                                        if baseline else ''))
+    for key, row in results.items():
+        peak = row['alloc_peak_bytes']
+        change = ''
+        old = (baseline or {}).get(key)
+        if old:
+            change = '%+.1f%%' % ((old['seconds'] / row['seconds'] - 1) * 100)
+        print('%-36s %10.1f %12.0f %12s  %s' % (
+            key, row['mb_per_s'], row['fields_per_s'],
+            '-' if peak is None else '%.0f' % (peak / 1024), change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('workloads', nargs='*', metavar='WORKLOAD',
+                        help='workloads to run: %s (default: all)'
+                             % ', '.join(WORKLOADS))
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply sizes and field counts (default: 1)')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='parses per measurement, the median is kept '
+                             '(default: 3)')
+    parser.add_argument('--alloc-limit', type=int, default=256 << 20,
+                        help='largest body to trace allocations for')
+    parser.add_argument('--spool-limit', type=int, default=64 << 20,
+                        help='larger generated bodies go to a temporary file')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='show the change against JSON results in FILE')
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error('unknown workload: %s' % name)
+
+    results = run(args.workloads or list(WORKLOADS), args.scale, args.repeats,
+                  args.alloc_limit, args.spool_limit)
+    if args.json:
+        json.dump({'python': sys.version, 'scale': args.scale,
+                   'results': results}, sys.stdout, indent=2)
+        print()
+        return
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print('Python %s, scale %g' % (sys.version.split()[0], args.scale))
+    report(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Import-time and cold-start benchmark.
+
+Every CGI request starts a new interpreter, so the cost of starting Python
+and importing cgi and cgitb is paid per request.  This benchmark measures
+it two ways:
+
+* imports: fresh interpreters run "import cgi", "import cgitb" and both,
+  under -X importtime, recording the wall time of the whole process, the
+  cumulative import time reported for the modules and how many modules
+  the import pulled in;
+* scripts: every script in cgi-bin/ is run as a real CGI process, with a
+  CGI environment and the request body on stdin, and its wall time is
+  recorded.
+
+Results can be saved and later compared; the comparison fails (exit status
+1) when a median or p95 time grows by more than --threshold, or when an
+import pulls in more modules than before:
+
+    python benchmarks/bench_startup.py --save startup.json
+    python benchmarks/bench_startup.py --compare startup.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+IMPORTS = {
+    'python': 'pass',
+    'import cgi': 'import cgi',
+    'import cgitb': 'import cgitb',
+    'import cgi, cgitb': 'import cgi, cgitb',
+}
+
+BODY = b'name=value&number=42&text=' + b'x' * 1000
+
+
+def child_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def cgi_env(script):
+    env = child_env()
+    env.update({
+        'GATEWAY_INTERFACE': 'CGI/1.1',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'REQUEST_METHOD': 'POST',
+        'SCRIPT_NAME': '/cgi-bin/' + os.path.basename(script),
+        'QUERY_STRING': 'a=1&b=2',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(BODY)),
+        'REMOTE_ADDR': '127.0.0.1',
+    })
+    return env
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def summarize(samples):
+    return {'median_ms': statistics.median(samples) * 1e3,
+            'p95_ms': percentile(samples, 95) * 1e3,
+            'runs': len(samples)}
+
+
+def parse_importtime(stderr, names):
+    """Return the summed cumulative import time of names, in ms."""
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line.split('|')
+        # Nested imports are indented, they are included in the parent
+        if (len(fields) == 3 and fields[2].strip() in names
+                and not fields[2].startswith('  ')):
+            total += int(fields[1])
+    return total / 1e3
+
+
+def bench_import(code, runs):
+    names = {'cgi', 'cgitb'}
+    program = ('import sys; _n = len(sys.modules); %s; '
+               'print(len(sys.modules) - _n)' % code)
+    cmd = [sys.executable, '-X', 'importtime', '-c', program]
+    env = child_env()
+    # Let the first run write the .pyc files the later runs use
+    subprocess.run(cmd, env=env, capture_output=True, check=True)
+    wall = []
+    importtime = []
+    modules = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, env=env, capture_output=True, check=True,
+                              text=True)
+        wall.append(time.perf_counter() - start)
+        importtime.append(parse_importtime(proc.stderr, names))
+        modules = int(proc.stdout)
+    result = summarize(wall)
+    result['import_ms'] = statistics.median(importtime)
+    result['modules'] = modules
+    return result
+
+
+def bench_script(script, runs):
+    cmd = [sys.executable, script]
+    env = cgi_env(script)
+    subprocess.run(cmd, env=env, input=BODY, capture_output=True)
+    wall = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, env=env, input=BODY, capture_output=True)
+        wall.append(time.perf_counter() - start)
+    result = summarize(wall)
+    result['exit_status'] = proc.returncode
+    result['output_bytes'] = len(proc.stdout)
+    return result
+
+
+def run(runs):
+    results = {'imports': {}, 'scripts': {}}
+    for name, code in IMPORTS.items():
+        results['imports'][name] = bench_import(code, runs)
+    for script in sorted(glob.glob(os.path.join(ROOT, 'cgi-bin', '*.py'))):
+        name = os.path.basename(script)
+        results['scripts'][name] = bench_script(script, runs)
+    return results
+
+
+def compare(old, new, threshold):
+    """Return a list of regressions of new against old."""
+    problems = []
+    for group in ('imports', 'scripts'):
+        for name, cur in new[group].items():
+            base = old.get(group, {}).get(name)
+            if base is None:
+                continue
+            for key in ('median_ms', 'p95_ms'):
+                if cur[key] > base[key] * (1 + threshold):
+                    problems.append('%s %s: %.2f ms -> %.2f ms'
+                                    % (name, key, base[key], cur[key]))
+            if cur.get('modules', 0) > base.get('modules', 0):
+                problems.append('%s: imports %d modules, was %d'
+                                % (name, cur['modules'], base['modules']))
+    return problems
+
+
+def report(results):
+    print('Python %s' % sys.version.split()[0])
+    print('%-24s %10s %10s %10s %8s' % ('', 'median ms', 'p95 ms',
+                                        'import ms', 'modules'))
+    for name, row in results['imports'].items():
+        print('%-24s %10.2f %10.2f %10.2f %8d' % (
+            name, row['median_ms'], row['p95_ms'], row['import_ms'],
+            row['modules']))
+    for name, row in results['scripts'].items():
+        print('%-24s %10.2f %10.2f %10s %8s' % (
+            name, row['median_ms'], row['p95_ms'], '', ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20,
+                        help='interpreters started per case (default: 20)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results to FILE as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='fail if the results regress against FILE')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative slowdown (default: 0.25)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    results = run(args.runs)
+    results['python'] = sys.version
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        report(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(json.load(f), results, args.threshold)
+        for problem in problems:
+            print('REGRESSION: ' + problem, file=sys.stderr)
+        if problems:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
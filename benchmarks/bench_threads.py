@@ -0,0 +1,119 @@
+"""Multi-threaded parsing throughput benchmark.
+
+Parses the same generated requests from a growing number of threads, each
+request with its own environ and an explicit cgi.ParserConfig, and reports
+how throughput scales with the thread count.  On a regular CPython build the
+GIL limits the speedup; run it with a free-threaded build (python3.13t or
+later) to see parsing scale with cores:
+
+    python benchmarks/bench_threads.py
+    python3.13t benchmarks/bench_threads.py --threads 1,2,4,8,16
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import cgi
+
+
+BOUNDARY = "----benchmark-boundary"
+
+
+def make_request(fields, file_size):
+    """Return (environ, body) for a multipart/form-data request."""
+    parts = []
+    for i in range(fields):
+        parts.append('--%s\r\nContent-Disposition: form-data; name="f%d"'
+                     '\r\n\r\nvalue %d\r\n' % (BOUNDARY, i, i))
+    parts.append('--%s\r\nContent-Disposition: form-data; name="upload"; '
+                 'filename="data.bin"\r\nContent-Type: application/octet-'
+                 'stream\r\n\r\n' % BOUNDARY)
+    body = ''.join(parts).encode('ascii')
+    line = b'0123456789abcdef' * 4 + b'\r\n'
+    body += line * (file_size // len(line))
+    body += b'\r\n--%s--\r\n' % BOUNDARY.encode('ascii')
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % BOUNDARY,
+        'CONTENT_LENGTH': str(len(body)),
+        'QUERY_STRING': 'a=1&b=2',
+    }
+    return environ, body
+
+
+def worker(config, environ, body, count, barrier, results):
+    barrier.wait()
+    start = time.perf_counter()
+    for _ in range(count):
+        with cgi.FieldStorage(BytesIO(body), environ=dict(environ),
+                              config=config) as form:
+            form.getvalue('upload')
+    results.append(time.perf_counter() - start)
+
+
+def run(threads, requests, environ, body):
+    config = cgi.ParserConfig()
+    barrier = threading.Barrier(threads + 1)
+    results = []
+    pool = [threading.Thread(target=worker,
+                             args=(config, environ, body, requests, barrier,
+                                   results))
+            for _ in range(threads)]
+    for t in pool:
+        t.start()
+    start = time.perf_counter()
+    barrier.wait()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return threads * requests / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', default='1,2,4,8',
+                        help='comma separated thread counts (default: 1,2,4,8)')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests parsed per thread (default: 200)')
+    parser.add_argument('--fields', type=int, default=50,
+                        help='small fields per request (default: 50)')
+    parser.add_argument('--file-size', type=int, default=64 * 1024,
+                        help='bytes in the uploaded file (default: 65536)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    environ, body = make_request(args.fields, args.file_size)
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    rows = []
+    base = None
+    for threads in [int(n) for n in args.threads.split(',')]:
+        rate = run(threads, args.requests, environ, body)
+        base = base or rate
+        rows.append({'threads': threads, 'requests_per_s': rate,
+                     'mb_per_s': rate * len(body) / 1e6,
+                     'speedup': rate / base})
+    if args.json:
+        json.dump({'python': sys.version, 'gil_enabled': gil,
+                   'cpus': os.cpu_count(), 'body_bytes': len(body),
+                   'results': rows}, sys.stdout, indent=2)
+        print()
+        return
+    print('Python %s, GIL %s, %s CPUs, %d byte requests'
+          % (sys.version.split()[0], 'enabled' if gil else 'disabled',
+             os.cpu_count(), len(body)))
+    print('%8s %14s %10s %8s' % ('threads', 'requests/s', 'MB/s', 'speedup'))
+    for row in rows:
+        print('%8d %14.1f %10.1f %7.2fx' % (row['threads'],
+              row['requests_per_s'], row['mb_per_s'], row['speedup']))
+
+
+if __name__ == '__main__':
+    main()
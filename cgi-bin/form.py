@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""Test CGI script that parses the request and echoes the form.
+
+This is the typical shape of a small CGI script: enable cgitb, build a
+FieldStorage from the environment and stdin, and print the fields.
+"""
+import cgi
+import cgitb
+
+cgitb.enable()
+
+form = cgi.FieldStorage()
+
+print("Content-Type: text/plain")
+print()
+for key in sorted(form.keys()):
+    field = form[key]
+    if isinstance(field, list):
+        print("%s: %d values" % (key, len(field)))
+    elif field.filename:
+        print("%s: file %s, %d bytes" % (key, field.filename,
+                                         len(field.value)))
+    else:
+        print("%s: %s" % (key, field.value))
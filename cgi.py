@@ -36,22 +36,26 @@ __version__ = "2.6"
 # Imports
 # =======
 
-from io import StringIO, BytesIO, TextIOWrapper
-from collections.abc import Mapping
+# Only modules that are loaded at interpreter startup anyway are imported
+# here.  Every CGI request pays for "import cgi", so heavier modules are
+# imported by the functions that need them; see __getattr__() below for
+# the names that used to be module attributes.
+
+from io import (StringIO, BytesIO, TextIOWrapper, FileIO, RawIOBase,
+                BufferedReader, BufferedWriter)
 import sys
 import os
-import urllib.parse
-from email.parser import FeedParser
-from email.message import Message
-import html
-import locale
-import tempfile
-import warnings
-
-__all__ = ["MiniFieldStorage", "FieldStorage", "parse", "parse_multipart",
-           "parse_header", "test", "print_exception", "print_environ",
-           "print_form", "print_directory", "print_arguments",
-           "print_environ_usage"]
+import _thread
+# As in threading: importing weakref would cost every request
+from _weakrefset import WeakSet as _WeakSet
+
+__all__ = ["MiniFieldStorage", "FieldStorage", "Request", "ParserConfig",
+           "ParseMetrics", "ProgressFile", "ReadTimeout", "parse",
+           "parse_multipart", "parse_records", "parse_json", "parse_header",
+           "open_file_count", "recv_fd", "enable_profiling", "enable_recording",
+           "replay", "serve_workers", "serve_fork", "serve", "loadtest", "test",
+           "print_exception", "print_environ", "print_form", "print_directory",
+           "print_arguments", "print_environ_usage"]
 
 # Logging support
 # ===============
@@ -83,6 +87,7 @@ def initlog(*allargs):
 
     """
     global log, logfile, logfp
+    import warnings
     warnings.warn("cgi.log() is deprecated as of 3.10. Use logging instead",
                   DeprecationWarning, stacklevel=2)
     if logfile and not logfp:
@@ -123,8 +128,126 @@ log = initlog           # The current logging function
 # 0 ==> unlimited input
 maxlen = 0
 
+# Default limits on compressed request bodies; 0 ==> unlimited.  The
+# decompressed size is also limited by maxlen, if set.
+max_decompressed_size = 0
+max_compression_ratio = 200
+
+class ParserConfig:
+
+    """Settings for parsing a request, passed explicitly.
+
+    Giving a ParserConfig to parse(), parse_multipart(), parse_records(),
+    parse_json() or FieldStorage makes parsing independent of process
+    state, so that requests can be parsed concurrently in threads: its
+    limits are used instead of the maxlen, max_decompressed_size and
+    max_compression_ratio globals, sys.argv and sys.stdin are never used
+    as fallbacks, and the environ passed in is never modified.
+
+    The attributes, all set from keyword arguments of the same name, are:
+
+    maxlen: maximum content length; 0 means unlimited
+
+    encoding, errors: used to decode field names and values
+
+    keep_blank_values, strict_parsing, max_num_fields, separator: as
+        for FieldStorage
+
+    file_factory: callable taking a FieldStorage part and returning a
+        file for it, used by make_file(); None for temporary files
+
+    max_decompressed_size, max_compression_ratio: limits on bodies sent
+        with Content-Encoding gzip or deflate; 0 means unlimited
+
+    read_timeout, body_timeout: read deadlines in seconds, as for
+        FieldStorage; None means no deadline
+
+    input_buffer_size: size of the single buffer the body is read
+        through, as for FieldStorage; None for the default reads
+
+    metrics: whether FieldStorage collects ParseMetrics
+
+    pipeline_depth, digests, verify_content_md5, progress,
+        progress_bytes, progress_interval: as for FieldStorage
+
+    max_chunk_line, max_chunk_trailer: the longest chunk size line and
+        the largest trailer section, in bytes, of a chunked body
+
+    A function given a ParserConfig takes these settings from it alone:
+    passing one of them as an argument as well, with a value other than
+    the argument's default and the config's own, raises TypeError.
+
+    ParserConfig objects are not modified by parsing and can be shared
+    between threads.  Use replace() to derive a modified copy.
+    """
+
+    def __init__(self, *, maxlen=0, encoding='utf-8', errors='replace',
+                 keep_blank_values=False, strict_parsing=False,
+                 max_num_fields=None, separator='&', file_factory=None,
+                 max_decompressed_size=0, max_compression_ratio=200,
+                 read_timeout=None, body_timeout=None, input_buffer_size=None,
+                 metrics=False, pipeline_depth=None, digests=None,
+                 verify_content_md5=False, progress=None,
+                 progress_bytes=1<<20, progress_interval=1.0,
+                 max_chunk_line=1024, max_chunk_trailer=8192):
+        self.maxlen = maxlen
+        self.encoding = encoding
+        self.errors = errors
+        self.keep_blank_values = keep_blank_values
+        self.strict_parsing = strict_parsing
+        self.max_num_fields = max_num_fields
+        self.separator = separator
+        self.file_factory = file_factory
+        self.max_decompressed_size = max_decompressed_size
+        self.max_compression_ratio = max_compression_ratio
+        self.read_timeout = read_timeout
+        self.body_timeout = body_timeout
+        self.input_buffer_size = input_buffer_size
+        self.metrics = metrics
+        self.pipeline_depth = pipeline_depth
+        self.digests = digests
+        self.verify_content_md5 = verify_content_md5
+        self.progress = progress
+        self.progress_bytes = progress_bytes
+        self.progress_interval = progress_interval
+        self.max_chunk_line = max_chunk_line
+        self.max_chunk_trailer = max_chunk_trailer
+
+    def __repr__(self):
+        return "ParserConfig(%s)" % ", ".join(
+            "%s=%r" % item for item in vars(self).items())
+
+    def replace(self, **changes):
+        """Return a copy of this configuration with some attributes changed."""
+        settings = dict(vars(self))
+        settings.update(changes)
+        return self.__class__(**settings)
+
+    @classmethod
+    def _from_globals(cls, **settings):
+        """Internal: snapshot the module globals for legacy callers."""
+        for name, value in (('maxlen', maxlen),
+                            ('max_decompressed_size', max_decompressed_size),
+                            ('max_compression_ratio', max_compression_ratio)):
+            if settings.get(name) is None:
+                settings[name] = value
+        return cls(**settings)
+
+    def _check(self, **arguments):
+        """Internal: reject arguments that disagree with this config.
+
+        Each keyword names a setting and maps it to the (value, default)
+        of the argument passed alongside the config.
+        """
+        for name, (value, default) in arguments.items():
+            if value != default and value != getattr(self, name):
+                raise TypeError('%s=%r conflicts with the %s=%r of config'
+                                % (name, value, name, getattr(self, name)))
+
+
 def parse(fp=None, environ=os.environ, keep_blank_values=0,
-          strict_parsing=0, separator='&'):
+          strict_parsing=0, separator='&', *, max_decompressed_size=None,
+          max_compression_ratio=None, config=None):
     """Parse a query in the environment or from a file (default stdin)
 
         Arguments, all optional:
@@ -146,61 +269,112 @@ def parse(fp=None, environ=os.environ, keep_blank_values=0,
 
         separator: str. The symbol to use for separating the query arguments.
             Defaults to &.
-    """
-    if fp is None:
-        fp = sys.stdin
 
-    # field keys and values (except for files) are returned as strings
-    # an encoding is required to decode the bytes read from self.fp
-    if hasattr(fp,'encoding'):
-        encoding = fp.encoding
+        max_decompressed_size, max_compression_ratio: limits on a body
+            sent with Content-Encoding gzip or deflate; see FieldStorage.
+
+        config: ParserConfig.  If given, its settings are used instead of
+            the module globals, and the other arguments must be left at
+            their defaults or agree with it (see ParserConfig); fp is
+            required for a POST request, sys.argv is ignored and environ
+            is left unchanged.
+    """
+    isolated = config is not None
+    if isolated:
+        config._check(keep_blank_values=(keep_blank_values, 0),
+                      strict_parsing=(strict_parsing, 0),
+                      separator=(separator, '&'),
+                      max_decompressed_size=(max_decompressed_size, None),
+                      max_compression_ratio=(max_compression_ratio, None))
+        keep_blank_values = config.keep_blank_values
+        strict_parsing = config.strict_parsing
+        separator = config.separator
+        encoding = config.encoding
     else:
-        encoding = 'latin-1'
+        config = ParserConfig._from_globals(
+            max_decompressed_size=max_decompressed_size,
+            max_compression_ratio=max_compression_ratio)
+        if fp is None:
+            fp = sys.stdin
+
+        # field keys and values (except for files) are returned as strings
+        # an encoding is required to decode the bytes read from self.fp
+        if hasattr(fp,'encoding'):
+            encoding = fp.encoding
+        else:
+            encoding = 'latin-1'
 
     # fp.read() must return bytes
     if isinstance(fp, TextIOWrapper):
         fp = fp.buffer
 
-    if not 'REQUEST_METHOD' in environ:
-        environ['REQUEST_METHOD'] = 'GET'       # For testing stand-alone
-    if environ['REQUEST_METHOD'] == 'POST':
+    if isolated:
+        argv = []
+        method = environ.get('REQUEST_METHOD', 'GET')
+    else:
+        argv = sys.argv[1:]
+        if not 'REQUEST_METHOD' in environ:
+            environ['REQUEST_METHOD'] = 'GET'       # For testing stand-alone
+        method = environ['REQUEST_METHOD']
+    if method == 'POST':
+        if fp is None:
+            raise TypeError("fp is required for a POST request")
         ctype, pdict = parse_header(environ['CONTENT_TYPE'])
+        clength = -1
+        if not _is_chunked(environ) and 'CONTENT_LENGTH' in environ:
+            try:
+                clength = int(environ['CONTENT_LENGTH'])
+            except ValueError:
+                pass
+            if config.maxlen and clength > config.maxlen:
+                raise ValueError('Maximum content length exceeded')
+        raw_fp = fp
+        fp, clength = _decode_body(fp, environ, clength, config)
         if ctype == 'multipart/form-data':
+            if isolated:
+                return parse_multipart(fp, pdict, config=config)
             return parse_multipart(fp, pdict, separator=separator)
         elif ctype == 'application/x-www-form-urlencoded':
-            clength = int(environ['CONTENT_LENGTH'])
-            if maxlen and clength > maxlen:
-                raise ValueError('Maximum content length exceeded')
+            if fp is raw_fp:
+                clength = int(environ['CONTENT_LENGTH'])
             qs = fp.read(clength).decode(encoding)
         else:
             qs = ''                     # Unknown content-type
         if 'QUERY_STRING' in environ:
             if qs: qs = qs + '&'
             qs = qs + environ['QUERY_STRING']
-        elif sys.argv[1:]:
+        elif argv:
             if qs: qs = qs + '&'
-            qs = qs + sys.argv[1]
-        environ['QUERY_STRING'] = qs    # XXX Shouldn't, really
+            qs = qs + argv[0]
+        if not isolated:
+            environ['QUERY_STRING'] = qs    # XXX Shouldn't, really
     elif 'QUERY_STRING' in environ:
         qs = environ['QUERY_STRING']
     else:
-        if sys.argv[1:]:
-            qs = sys.argv[1]
+        if argv:
+            qs = argv[0]
         else:
             qs = ""
-        environ['QUERY_STRING'] = qs    # XXX Shouldn't, really
+        if not isolated:
+            environ['QUERY_STRING'] = qs    # XXX Shouldn't, really
+    import urllib.parse
     return urllib.parse.parse_qs(qs, keep_blank_values, strict_parsing,
                                  encoding=encoding, separator=separator)
 
 
-def parse_multipart(fp, pdict, encoding="utf-8", errors="replace", separator='&'):
+def parse_multipart(fp, pdict, encoding="utf-8", errors="replace", separator='&',
+                    *, config=None):
     """Parse multipart input.
 
     Arguments:
     fp   : input file
-    pdict: dictionary containing other parameters of content-type header
+    pdict: dictionary containing other parameters of content-type header;
+        the boundary may be bytes or str
     encoding, errors: request encoding and error handler, passed to
         FieldStorage
+    config: ParserConfig passed to FieldStorage, whose settings are used
+        instead of encoding, errors and separator, which must then be left
+        at their defaults or agree with it
 
     Returns a dictionary just like parse_qs(): keys are the field names, each
     value is a list of values for that field. For non-file fields, the value
@@ -208,7 +382,10 @@ def parse_multipart(fp, pdict, encoding="utf-8", errors="replace", separator='&'
     """
     # RFC 2046, Section 5.1 : The "multipart" boundary delimiters are always
     # represented as 7bit US-ASCII.
-    boundary = pdict['boundary'].decode('ascii')
+    from email.message import Message
+    boundary = pdict['boundary']
+    if isinstance(boundary, bytes):
+        boundary = boundary.decode('ascii')
     ctype = "multipart/form-data; boundary={}".format(boundary)
     headers = Message()
     headers.set_type(ctype)
@@ -217,9 +394,115 @@ def parse_multipart(fp, pdict, encoding="utf-8", errors="replace", separator='&'
     except KeyError:
         pass
     fs = FieldStorage(fp, headers=headers, encoding=encoding, errors=errors,
-        environ={'REQUEST_METHOD': 'POST'}, separator=separator)
+        environ={'REQUEST_METHOD': 'POST'}, separator=separator, config=config)
     return {k: fs.getlist(k) for k in fs}
 
+_NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson',
+                 'application/jsonl')
+
+def _open_body(fp, environ, config):
+    """Return a reader for the decoded request body and its content type.
+
+    The reader never reads past CONTENT_LENGTH, and maxlen is enforced.
+    """
+    if config is None:
+        config = ParserConfig._from_globals()
+        if fp is None:
+            fp = sys.stdin.buffer
+    if fp is None:
+        raise TypeError("fp is required when a ParserConfig is given")
+    if isinstance(fp, TextIOWrapper):
+        fp = fp.buffer
+    clength = -1
+    if not _is_chunked(environ) and 'CONTENT_LENGTH' in environ:
+        try:
+            clength = int(environ['CONTENT_LENGTH'])
+        except ValueError:
+            pass
+        if config.maxlen and clength > config.maxlen:
+            raise ValueError('Maximum content length exceeded')
+    fp, clength = _decode_body(fp, environ, clength, config)
+    if clength >= 0:
+        fp = _LimitedReader(fp, clength)
+    return fp, parse_header(environ.get('CONTENT_TYPE', ''))
+
+def parse_records(fp=None, environ=os.environ, encoding=None,
+                  errors='strict', max_record_size=1<<20, dialect='excel',
+                  *, config=None):
+    """Iterate over the records of an NDJSON or CSV request body.
+
+        Arguments, all optional:
+
+        fp              : file pointer; default: sys.stdin.buffer
+
+        environ         : environment dictionary; default: os.environ
+
+        encoding, errors: used to decode the body; the encoding defaults
+            to the charset of the content-type, or UTF-8
+
+        max_record_size: int. A line longer than this many bytes raises
+            a ValueError.
+
+        dialect: the csv dialect used for text/csv bodies.
+
+        config: ParserConfig providing maxlen and the decompression
+            limits; fp is then required.
+
+    The body is read incrementally, so memory use does not depend on its
+    size.  For application/x-ndjson, each non-blank line is decoded with
+    json.loads(); for text/csv, rows are yielded as lists of strings.
+    Other content types raise a ValueError.
+    """
+    import codecs
+    fp, (ctype, pdict) = _open_body(fp, environ, config)
+    if encoding is None:
+        encoding = pdict.get('charset', 'utf-8')
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+
+    def lines():
+        while True:
+            line = fp.readline(max_record_size + 1)
+            if len(line) > max_record_size:
+                raise ValueError('Maximum record size exceeded')
+            if not line:
+                tail = decoder.decode(b"", True)
+                if tail:
+                    yield tail
+                return
+            yield decoder.decode(line)
+
+    if ctype in _NDJSON_TYPES:
+        import json
+        for line in lines():
+            if line.strip():
+                yield json.loads(line)
+    elif ctype == 'text/csv':
+        import csv
+        yield from csv.reader(lines(), dialect)
+    else:
+        raise ValueError('Unsupported content type for records: %r'
+                         % (ctype,))
+
+def parse_json(fp=None, environ=os.environ, max_size=1<<20, *, config=None):
+    """Load an application/json request body of at most max_size bytes.
+
+    The body is decoded with json.loads(); a larger body raises a
+    ValueError before it is read into memory in full, as does a content
+    type other than application/json or a +json suffix type.  config is
+    as for parse_records().
+    """
+    import json
+    fp, (ctype, pdict) = _open_body(fp, environ, config)
+    if ctype != 'application/json' and not ctype.endswith('+json'):
+        raise ValueError('Unsupported content type for JSON: %r' % (ctype,))
+    data = fp.read(max_size + 1)
+    if len(data) > max_size:
+        raise ValueError('Maximum JSON size exceeded')
+    encoding = pdict.get('charset')
+    if encoding:
+        data = data.decode(encoding)
+    return json.loads(data)
+
 def _parseparam(s):
     while s[:1] == ';':
         s = s[1:]
@@ -253,6 +536,609 @@ def parse_header(line):
     return key, pdict
 
 
+# Input layers
+# ============
+
+class ReadTimeout(TimeoutError):
+
+    """The client did not send the request body in time."""
+
+class _InputLayer:
+
+    """Base class for readers layered over the request body.
+
+    Subclasses implement _fill(), which returns the next chunk of bytes
+    (b"" at end of input); this class provides the read() and readline()
+    methods used by the parser on top of those chunks.
+    """
+
+    def __init__(self):
+        self._buf = b""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        raise NotImplementedError
+
+    def _more(self):
+        """Append the next chunk to the buffer; return False at EOF."""
+        if self._eof:
+            return False
+        chunk = self._fill()
+        if not chunk:
+            self._eof = True
+            return False
+        if self._pos:
+            self._buf = self._buf[self._pos:] + chunk
+            self._pos = 0
+        elif self._buf:
+            self._buf += chunk
+        else:
+            self._buf = chunk
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._buf[self._pos:]]
+            self._buf = b""
+            self._pos = 0
+            while not self._eof:
+                chunk = self._fill()
+                if not chunk:
+                    self._eof = True
+                    break
+                chunks.append(chunk)
+            return b"".join(chunks)
+        while len(self._buf) - self._pos < size and self._more():
+            pass
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        scan = self._pos
+        while True:
+            i = self._buf.find(b"\n", scan)
+            if i >= 0:
+                end = i + 1
+                break
+            avail = len(self._buf) - self._pos
+            if 0 <= size <= avail:
+                end = self._pos + size
+                break
+            if not self._more():
+                end = len(self._buf)
+                break
+            # _more() may have compacted the buffer
+            scan = self._pos + avail
+        if 0 <= size < end - self._pos:
+            end = self._pos + size
+        line = self._buf[self._pos:end]
+        self._pos = end
+        return line
+
+    def close(self):
+        pass
+
+
+class _LimitedReader(_InputLayer):
+
+    """Read at most length bytes from fp."""
+
+    chunksize = 1 << 16
+
+    def __init__(self, fp, length):
+        super().__init__()
+        self.fp = fp
+        self._todo = length
+
+    def _fill(self):
+        if self._todo <= 0:
+            return b""
+        data = self.fp.read(min(self._todo, self.chunksize))
+        if not isinstance(data, bytes):
+            raise ValueError("%s should return bytes, got %s"
+                             % (self.fp, type(data).__name__))
+        self._todo -= len(data)
+        return data
+
+
+class _Deadline:
+
+    """Deadlines for reading a request body from a file descriptor.
+
+    wait() blocks until fd is readable, raising ReadTimeout if no data
+    arrives for read_timeout seconds or once body_timeout seconds have
+    passed since the deadline was created.  If fd is None, only the
+    total deadline can be enforced, by check().
+    """
+
+    def __init__(self, fd, read_timeout=None, body_timeout=None):
+        import time
+        self.fd = fd
+        self.read_timeout = read_timeout
+        self.body_timeout = body_timeout
+        self._clock = time.monotonic
+        self._deadline = None
+        if body_timeout is not None:
+            self._deadline = self._clock() + body_timeout
+        self._poll = None
+        if fd is not None:
+            import select
+            if hasattr(select, 'poll'):
+                self._poll = select.poll()
+                self._poll.register(fd, select.POLLIN | select.POLLPRI)
+            else:
+                self._select = select.select
+
+    def _expired(self):
+        return ReadTimeout('Request body not received within %s seconds'
+                           % self.body_timeout)
+
+    def check(self):
+        """Return how long the next read may wait, or None."""
+        timeout = self.read_timeout
+        if self._deadline is not None:
+            remaining = self._deadline - self._clock()
+            if remaining <= 0:
+                raise self._expired()
+            if timeout is None or remaining < timeout:
+                return remaining
+        return timeout
+
+    def wait(self):
+        timeout = self.check()
+        if timeout is None or self.fd is None:
+            return
+        if self._poll is not None:
+            ready = self._poll.poll(timeout * 1000)
+        else:
+            ready = self._select([self.fd], [], [], timeout)[0]
+        if ready:
+            return
+        if self._deadline is not None and self._clock() >= self._deadline:
+            raise self._expired()
+        raise ReadTimeout('No request data received for %s seconds'
+                          % self.read_timeout)
+
+
+def _fileno(fp):
+    """Return the file descriptor of fp, or None."""
+    try:
+        return fp.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class _DeadlineReader(_InputLayer):
+
+    """Read at most length bytes from fp, enforcing deadlines.
+
+    See _Deadline.  When fp has a file descriptor, it is read directly
+    with os.read(), so fp must not have been read from before; otherwise
+    the deadlines are only checked between reads.
+    """
+
+    chunksize = 1 << 16
+
+    def __init__(self, fp, length=-1, read_timeout=None, body_timeout=None):
+        super().__init__()
+        self.fp = fp
+        self._todo = length
+        self._fd = _fileno(fp)
+        self.deadline = _Deadline(self._fd, read_timeout, body_timeout)
+
+    def _fill(self):
+        if self._todo == 0:
+            return b""
+        n = self.chunksize if self._todo < 0 else min(self._todo,
+                                                       self.chunksize)
+        self.deadline.wait()
+        if self._fd is not None:
+            data = os.read(self._fd, n)
+        else:
+            data = self.fp.read(n)
+            if not isinstance(data, bytes):
+                raise ValueError("%s should return bytes, got %s"
+                                 % (self.fp, type(data).__name__))
+        if self._todo > 0:
+            self._todo -= len(data)
+        return data
+
+
+class _RawInput:
+
+    """Read at most length bytes from fp through one large buffer.
+
+    The buffer of bufsize bytes is allocated once and refilled in place
+    with readinto(); when fp has a file descriptor, it is read directly,
+    bypassing the small buffer of sys.stdin.buffer, so fp must not have
+    been read from before.  reads and bytes count the read calls made
+    and the bytes they returned.  If deadline is given, its wait() is
+    called before each read.
+    """
+
+    def __init__(self, fp, length=-1, bufsize=1<<20, deadline=None):
+        fd = _fileno(fp)
+        if fd is not None:
+            self.raw = FileIO(fd, 'rb', closefd=False)
+        else:
+            self.raw = fp
+        self._readinto = getattr(self.raw, 'readinto', None)
+        self._todo = length
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = self._end = 0
+        self._eof = False
+        self.deadline = deadline
+        self.reads = 0
+        self.bytes = 0
+
+    def _refill(self):
+        """Read more data into the buffer; return False at EOF."""
+        if self._eof or self._todo == 0:
+            self._eof = True
+            return False
+        if self._start:
+            # Move the unread data to the front of the buffer
+            n = self._end - self._start
+            self._buf[:n] = self._view[self._start:self._end]
+            self._start, self._end = 0, n
+        space = len(self._buf) - self._end
+        if self._todo > 0:
+            space = min(space, self._todo)
+        if self.deadline is not None:
+            self.deadline.wait()
+        self.reads += 1
+        if self._readinto is not None:
+            n = self._readinto(self._view[self._end:self._end + space])
+        else:
+            data = self.raw.read(space)
+            if not isinstance(data, bytes):
+                raise ValueError("%s should return bytes, got %s"
+                                 % (self.raw, type(data).__name__))
+            n = len(data)
+            self._buf[self._end:self._end + n] = data
+        if not n:
+            self._eof = True
+            return False
+        self._end += n
+        self.bytes += n
+        if self._todo > 0:
+            self._todo -= n
+        return True
+
+    def _take(self, n):
+        data = bytes(self._view[self._start:self._start + n])
+        self._start += n
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                if self._end > self._start:
+                    chunks.append(self._take(self._end - self._start))
+                if not self._refill():
+                    return b"".join(chunks)
+        chunks = []
+        while size > 0:
+            if self._end == self._start and not self._refill():
+                break
+            data = self._take(min(size, self._end - self._start))
+            chunks.append(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        chunks = []
+        while True:
+            i = self._buf.find(b"\n", self._start, self._end)
+            if i >= 0:
+                n = i + 1 - self._start
+            else:
+                n = self._end - self._start
+            if 0 <= size < n:
+                n = size
+            if i >= 0 or n == size or (n and self._end == len(self._buf)):
+                data = self._take(n)
+                if i >= 0 or n == size:
+                    chunks.append(data)
+                    return b"".join(chunks)
+                # A line longer than the buffer
+                chunks.append(data)
+                if size > 0:
+                    size -= len(data)
+            elif not self._refill():
+                chunks.append(self._take(n))
+                return b"".join(chunks)
+
+    def close(self):
+        pass
+
+
+class _PipelinedReader(_InputLayer):
+
+    """Read the body on a background thread into a bounded queue.
+
+    At most depth chunks are buffered ahead of the parser, so network
+    reads overlap with the parser's writes to disk while memory stays
+    bounded.  If length is not negative, no more than length bytes are
+    read from fp.
+    """
+
+    chunksize = 1 << 16
+
+    def __init__(self, fp, length=-1, depth=8):
+        import queue
+        import threading
+        super().__init__()
+        self._queue = queue.Queue(max(1, depth))
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._reading = False
+        self._bounded = length >= 0
+        self._thread = threading.Thread(target=self._run, args=(fp, length),
+                                        name="cgi-reader", daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        import queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, fp, length):
+        # read1() returns what has arrived instead of waiting for a full
+        # chunk, so the parser sees the data as soon as the client sends it
+        read = getattr(fp, 'read1', fp.read)
+        try:
+            todo = length
+            while todo != 0:
+                with self._lock:
+                    if self._stop.is_set():
+                        return
+                    self._reading = True
+                n = self.chunksize if todo < 0 else min(todo, self.chunksize)
+                try:
+                    data = read(n)
+                finally:
+                    self._reading = False
+                if not isinstance(data, bytes):
+                    raise ValueError("%s should return bytes, got %s"
+                                     % (fp, type(data).__name__))
+                if not data:
+                    break
+                if todo > 0:
+                    todo -= len(data)
+                if not self._put(data):
+                    return
+            self._put(b"")
+        except BaseException as exc:
+            self._put(exc)
+
+    def _fill(self):
+        item = self._queue.get()
+        if isinstance(item, BaseException):
+            self._eof = True
+            raise item
+        return item
+
+    def close(self):
+        import queue
+        with self._lock:
+            self._stop.set()
+            reading = self._reading
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        # Wait for the thread so that it reads nothing more from fp, unless
+        # it is blocked in a read, which may not return until the client
+        # sends the rest of the body: it is a daemon thread and stops after
+        # that read.
+        if self._bounded and not reading:
+            self._thread.join()
+
+
+class _ChunkedReader(_InputLayer):
+
+    """Decode a body sent with Transfer-Encoding: chunked.
+
+    Chunk data is returned as it arrives, at most chunksize bytes at a
+    time.  Chunk-size lines longer than max_line bytes, trailers longer
+    than max_trailer bytes and a decoded body larger than max_size
+    (if not 0) raise ValueError.
+    """
+
+    chunksize = 1 << 16
+
+    def __init__(self, fp, max_line=1024, max_trailer=8192, max_size=0):
+        super().__init__()
+        self.fp = fp
+        self.max_line = max_line
+        self.max_trailer = max_trailer
+        self.max_size = max_size
+        self.size = 0
+        self._todo = 0
+        self._done = False
+
+    def _readline(self):
+        line = self.fp.readline(self.max_line + 1)
+        if not isinstance(line, bytes):
+            raise ValueError("%s should return bytes, got %s"
+                             % (self.fp, type(line).__name__))
+        if len(line) > self.max_line:
+            raise ValueError('Chunk size line too long')
+        if not line.endswith(b"\n"):
+            raise ValueError('Incomplete chunked body')
+        return line
+
+    def _fill(self):
+        if self._done:
+            return b""
+        if not self._todo:
+            line = self._readline()
+            size = line.split(b";", 1)[0].strip()
+            if not size or size.strip(b"0123456789abcdefABCDEF"):
+                raise ValueError('Invalid chunk size line: %r' % (line,))
+            self._todo = int(size, 16)
+            if not self._todo:
+                self._read_trailers()
+                return b""
+        data = self.fp.read(min(self._todo, self.chunksize))
+        if not data:
+            raise ValueError('Incomplete chunked body')
+        self._todo -= len(data)
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            raise ValueError('Maximum content length exceeded')
+        if not self._todo and self._readline().strip():
+            raise ValueError('Missing CRLF after chunk data')
+        return data
+
+    def _read_trailers(self):
+        self._done = True
+        total = 0
+        while True:
+            line = self._readline()
+            total += len(line)
+            if total > self.max_trailer:
+                raise ValueError('Chunked trailers too long')
+            if not line.strip():
+                break
+
+
+def _is_chunked(environ):
+    """Return true if the request body uses chunked transfer coding."""
+    codings = environ.get('HTTP_TRANSFER_ENCODING', '')
+    return 'chunked' in [c.strip().lower() for c in codings.split(',')]
+
+
+class _DecompressingReader(_InputLayer):
+
+    """Decode a body sent with Content-Encoding gzip or deflate.
+
+    At most length compressed bytes are read from fp (all of it if length
+    is negative).  Output is produced at most chunksize bytes at a time,
+    so memory use does not depend on the expansion ratio.  A decompressed
+    body larger than max_size (if not 0), or one expanding more than
+    max_ratio times (if not 0, once past the first ratio_grace bytes),
+    raises ValueError.
+    """
+
+    chunksize = 1 << 16
+    ratio_grace = 1 << 20
+
+    def __init__(self, fp, coding, length=-1, max_size=0, max_ratio=0):
+        super().__init__()
+        self.fp = fp
+        self.coding = coding
+        self.max_size = max_size
+        self.max_ratio = max_ratio
+        self.size = 0
+        self.consumed = 0
+        self._todo = length
+        self._tail = b""
+        self._zobj = None
+
+    def _decompressor(self, data):
+        import zlib
+        if self.coding in ('gzip', 'x-gzip'):
+            wbits = 16 + zlib.MAX_WBITS
+        elif (len(data) >= 2 and data[0] & 0x0f == 8 and
+              (data[0] << 8 | data[1]) % 31 == 0):
+            wbits = zlib.MAX_WBITS      # zlib wrapper, as per RFC 9110
+        else:
+            wbits = -zlib.MAX_WBITS     # raw deflate, as sent by some clients
+        return zlib.decompressobj(wbits)
+
+    def _read_raw(self):
+        if self._todo == 0:
+            return b""
+        n = self.chunksize if self._todo < 0 else min(self._todo,
+                                                       self.chunksize)
+        data = self.fp.read(n)
+        if not isinstance(data, bytes):
+            raise ValueError("%s should return bytes, got %s"
+                             % (self.fp, type(data).__name__))
+        if self._todo > 0:
+            self._todo -= len(data)
+        self.consumed += len(data)
+        return data
+
+    def _fill(self):
+        import zlib
+        while True:
+            data = self._tail
+            if self._zobj is not None and self._zobj.eof:
+                data = self._zobj.unused_data or self._read_raw()
+                if not data:
+                    return b""
+                if self.coding not in ('gzip', 'x-gzip'):
+                    raise ValueError('Trailing data after %s body'
+                                     % self.coding)
+                # A gzip body may hold several members (RFC 1952, 2.2)
+                self._zobj = None
+            elif not data:
+                data = self._read_raw()
+                if not data:
+                    if self._zobj is None:
+                        return b""      # empty body
+                    raise ValueError('Incomplete %s body' % self.coding)
+            if self._zobj is None:
+                self._zobj = self._decompressor(data)
+            try:
+                out = self._zobj.decompress(data, self.chunksize)
+            except zlib.error as err:
+                raise ValueError('Invalid %s body: %s'
+                                 % (self.coding, err)) from None
+            self._tail = self._zobj.unconsumed_tail
+            if out:
+                break
+        self.size += len(out)
+        if self.max_size and self.size > self.max_size:
+            raise ValueError('Maximum decompressed length exceeded')
+        if (self.max_ratio and self.size > self.ratio_grace and
+                self.size > self.max_ratio * self.consumed):
+            raise ValueError('Maximum compression ratio exceeded')
+        return out
+
+
+def _decode_body(fp, environ, length, config):
+    """Apply the transfer and content codings of a request body.
+
+    Return a new file object reading the decoded body and its length,
+    which is -1 if it is not known in advance.
+    """
+    if _is_chunked(environ):
+        fp = _ChunkedReader(fp, config.max_chunk_line,
+                            config.max_chunk_trailer, config.maxlen)
+        length = -1
+    codings = environ.get('HTTP_CONTENT_ENCODING', '')
+    codings = [c.strip().lower() for c in codings.split(',') if c.strip()]
+    if codings:
+        for coding in codings:
+            if coding not in ('gzip', 'x-gzip', 'deflate', 'identity'):
+                raise ValueError('Unsupported Content-Encoding: %s' % coding)
+        max_size = config.max_decompressed_size or config.maxlen
+        for coding in reversed(codings):
+            if coding != 'identity':
+                fp = _DecompressingReader(fp, coding, length, max_size,
+                                          config.max_compression_ratio)
+                length = -1
+    return fp, length
+
+
 # Classes for field storage
 # =========================
 
@@ -281,6 +1167,114 @@ class MiniFieldStorage:
         return "MiniFieldStorage(%r, %r)" % (self.name, self.value)
 
 
+class _ProgressTracker:
+
+    """Report the progress of reading a request body to a callback."""
+
+    def __init__(self, callback, every_bytes, interval):
+        import time
+        self.callback = callback
+        self.every_bytes = every_bytes
+        self.interval = interval
+        self.length = -1
+        self.bytes_read = 0
+        self._clock = time.monotonic
+        self._schedule()
+
+    def _schedule(self):
+        self._next_bytes = self.bytes_read + self.every_bytes
+        if self.interval is None:
+            self._next_time = float('inf')
+        else:
+            self._next_time = self._clock() + self.interval
+
+    def update(self, nbytes, part):
+        self.bytes_read += nbytes
+        if (self.bytes_read >= self._next_bytes or
+                self._clock() >= self._next_time):
+            self.report(part)
+
+    def report(self, part, done=False):
+        self._schedule()
+        self.callback(part.name, part.filename, self.bytes_read,
+                      self.length, done)
+
+
+class ParseMetrics:
+
+    """Counters and timings collected while a request is parsed.
+
+    Pass metrics=True (or an instance of this class) to FieldStorage to
+    have one attached to the form as its metrics attribute; all parts of
+    the form share it.  Times are in seconds, from time.monotonic().
+    Part data read line by line is written a line at a time, so only one
+    of these writes in 16 is timed, and write_time is extrapolated from
+    them.  log_line() returns everything on one line, for a request log.
+    """
+
+    _fields = ('bytes_read', 'parts', 'files_created', 'bytes_to_disk',
+               'bytes_to_memory', 'header_time', 'scan_time', 'write_time',
+               'total_time')
+
+    def __init__(self):
+        import time
+        self.clock = time.monotonic
+        self.bytes_read = 0
+        self.parts = 0
+        self.files_created = 0
+        self.bytes_to_disk = 0
+        self.bytes_to_memory = 0
+        self.header_time = 0.0
+        self.scan_time = 0.0
+        self.write_time = 0.0
+        self.total_time = 0.0
+        self._writes = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self._fields}
+
+    def log_line(self):
+        return ' '.join('%s=%.6f' % (name, value) if isinstance(value, float)
+                        else '%s=%d' % (name, value)
+                        for name, value in self.as_dict().items())
+
+    def __repr__(self):
+        return 'ParseMetrics(%s)' % self.log_line().replace(' ', ', ')
+
+
+class ProgressFile:
+
+    """Progress callback writing a small JSON file per request.
+
+    The file is named after request_id in directory, and replaced
+    atomically on every update, so that another process can poll it.
+    If request_id is None, it is taken from the UNIQUE_ID or
+    HTTP_X_REQUEST_ID environment variable.
+    """
+
+    def __init__(self, directory, request_id=None, environ=os.environ):
+        if request_id is None:
+            request_id = (environ.get('UNIQUE_ID') or
+                          environ.get('HTTP_X_REQUEST_ID'))
+            if not request_id:
+                raise ValueError('No request id for progress file')
+        request_id = _safe_filename(request_id)
+        self.request_id = request_id
+        self.path = os.path.join(directory, request_id + '.json')
+
+    def __call__(self, name, filename, bytes_read, length, done):
+        import json
+        import time
+        data = json.dumps({'request_id': self.request_id, 'name': name,
+                           'filename': filename, 'bytes_read': bytes_read,
+                           'content_length': length, 'done': done,
+                           'time': time.time()})
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+
 class FieldStorage:
 
     """Store a sequence of fields, reading multipart/form-data.
@@ -327,7 +1321,13 @@ class FieldStorage:
     def __init__(self, fp=None, headers=None, outerboundary=b'',
                  environ=os.environ, keep_blank_values=0, strict_parsing=0,
                  limit=None, encoding='utf-8', errors='replace',
-                 max_num_fields=None, separator='&'):
+                 max_num_fields=None, separator='&', *, digests=None,
+                 verify_content_md5=False, pipeline_depth=None,
+                 processors=None, executor=None, wait_processors=True,
+                 max_decompressed_size=None, max_compression_ratio=None,
+                 read_timeout=None, body_timeout=None, progress=None,
+                 progress_bytes=1<<20, progress_interval=1.0, config=None,
+                 input_buffer_size=None, metrics=None):
         """Constructor.  Read multipart/* until last part.
 
         Arguments, all optional:
@@ -370,22 +1370,163 @@ class FieldStorage:
         max_num_fields: int. If set, then __init__ throws a ValueError
             if there are more than n fields read by parse_qsl().
 
+        digests: list of digest factories such as hashlib.sha256 or
+            zlib.crc32.  Each part body is fed to every digest while it is
+            copied, and the hex results are stored in the part's digests
+            attribute, keyed by digest name.
+
+        verify_content_md5: flag indicating whether a Content-MD5 header on
+            a part should be checked against the part body.  A mismatch
+            raises a ValueError.
+
+        pipeline_depth: int.  If set, the request body is read on a
+            separate thread into a queue holding at most this many 64 KiB
+            buffers, so that reading the input overlaps with writing parts
+            to disk.  Only used at the top level of a POST or PUT request.
+
+        processors: list of callables taking a part.  As soon as a file
+            upload (a part with a filename) is complete, each processor is
+            submitted with it to executor, while parsing continues with the
+            next part.  The futures are stored in the part's futures
+            attribute.
+
+        executor: concurrent.futures.Executor used to run the processors;
+            by default a ThreadPoolExecutor is created for the request and
+            shut down when parsing is finished.
+
+        wait_processors: flag indicating whether the constructor waits for
+            all processors.  If true (the default), the results are stored
+            in the part's results attribute, in the order of processors,
+            and an exception raised by a processor is re-raised.
+
+        max_decompressed_size, max_compression_ratio: limits on a request
+            body sent with Content-Encoding gzip or deflate, which is
+            decompressed as it is read.  They default to the module
+            globals of the same name; 0 means unlimited.
+
+        read_timeout, body_timeout: seconds.  If set, ReadTimeout is raised
+            when no request body data arrives for read_timeout seconds, or
+            when the whole body has not arrived within body_timeout seconds.
+            Only used at the top level of a POST or PUT request.
+
+        progress: callable, called as progress(name, filename, bytes_read,
+            length, done) while the body is read, with the name and
+            filename of the part being read, the number of bytes read so
+            far and the content length (-1 if unknown).  It is called
+            at most once per progress_bytes bytes or progress_interval
+            seconds, whichever comes first, and a last time with done true.
+
+        config: ParserConfig.  If given, its settings are used instead of
+            the module globals (including enable_recording()'s metrics)
+            and of the arguments named like its attributes (all but fp,
+            headers, outerboundary, environ, limit, processors, executor
+            and wait_processors), which must be left at their defaults or
+            agree with it, or TypeError is raised;
+            metrics may still give the ParseMetrics instance to use if
+            config.metrics is true.  fp is then required for a request
+            with a body, and sys.argv is never used for the query string.
+            Without a config, one is made from the arguments and the
+            module globals.  Either way, the parts of a multipart form
+            share it.
+
+        input_buffer_size: int.  If set, the request body is read through
+            a single buffer of this many bytes, refilled with readinto()
+            directly from the file descriptor of fp if it has one, so a
+            large buffer means few read calls.  The number of reads and
+            bytes is then stored in the input_stats dictionary.  Only used
+            at the top level of a POST or PUT request.
+
+        metrics: true or a ParseMetrics instance.  If set, bytes read,
+            parts, temporary files and the time spent parsing headers,
+            scanning the body and writing part data are recorded in the
+            metrics attribute, shared by all the parts of the form.
+
         """
+        isolated = config is not None
+        if config is None:
+            config = ParserConfig._from_globals(
+                encoding=encoding, errors=errors,
+                keep_blank_values=keep_blank_values,
+                strict_parsing=strict_parsing, max_num_fields=max_num_fields,
+                separator=separator,
+                max_decompressed_size=max_decompressed_size,
+                max_compression_ratio=max_compression_ratio,
+                read_timeout=read_timeout, body_timeout=body_timeout,
+                input_buffer_size=input_buffer_size, metrics=bool(metrics),
+                pipeline_depth=pipeline_depth, digests=digests,
+                verify_content_md5=verify_content_md5,
+                progress=progress, progress_bytes=progress_bytes,
+                progress_interval=progress_interval)
+        elif not outerboundary:
+            # Parts get these from their parent, as max_num_fields is what
+            # is left of the parent's allowance, so only check them here.
+            config._check(
+                encoding=(encoding, 'utf-8'), errors=(errors, 'replace'),
+                keep_blank_values=(keep_blank_values, 0),
+                strict_parsing=(strict_parsing, 0),
+                max_num_fields=(max_num_fields, None),
+                separator=(separator, '&'),
+                max_decompressed_size=(max_decompressed_size, None),
+                max_compression_ratio=(max_compression_ratio, None),
+                read_timeout=(read_timeout, None),
+                body_timeout=(body_timeout, None),
+                input_buffer_size=(input_buffer_size, None),
+                pipeline_depth=(pipeline_depth, None),
+                digests=(digests, None),
+                verify_content_md5=(verify_content_md5, False),
+                progress=(progress, None),
+                progress_bytes=(progress_bytes, 1<<20),
+                progress_interval=(progress_interval, 1.0))
+            if metrics is not None and bool(metrics) != config.metrics:
+                raise TypeError('metrics=%r conflicts with the metrics=%r '
+                                'of config' % (metrics, config.metrics))
+            encoding = config.encoding
+            errors = config.errors
+            keep_blank_values = config.keep_blank_values
+            strict_parsing = config.strict_parsing
+            max_num_fields = config.max_num_fields
+            separator = config.separator
+        self.config = config
+        self._isolated = isolated
         method = 'GET'
         self.keep_blank_values = keep_blank_values
         self.strict_parsing = strict_parsing
         self.max_num_fields = max_num_fields
         self.separator = separator
+        self._digest_factories = config.digests
+        self.verify_content_md5 = config.verify_content_md5
+        self.digests = None
+        self._digest_objs = None
+        self.processors = processors
+        self.futures = self.results = None
+        if isinstance(progress, _ProgressTracker):
+            # A part, sharing the tracker of its form
+            self._progress = progress
+        elif config.progress is not None and not outerboundary:
+            self._progress = _ProgressTracker(config.progress,
+                                              config.progress_bytes,
+                                              config.progress_interval)
+        else:
+            self._progress = None
+        if config.metrics and not isinstance(metrics, ParseMetrics):
+            metrics = ParseMetrics()
+        elif (metrics is None and not isolated and not outerboundary and
+                _recorder is not None):
+            metrics = _recorder.metrics
+        self.metrics = metrics or None
+        if self.metrics is not None and not outerboundary:
+            start_time = self.metrics.clock()
         if 'REQUEST_METHOD' in environ:
             method = environ['REQUEST_METHOD'].upper()
         self.qs_on_post = None
         if method == 'GET' or method == 'HEAD':
             if 'QUERY_STRING' in environ:
                 qs = environ['QUERY_STRING']
-            elif sys.argv[1:]:
+            elif not isolated and sys.argv[1:]:
                 qs = sys.argv[1]
             else:
                 qs = ""
+            import locale
             qs = qs.encode(locale.getpreferredencoding(), 'surrogateescape')
             fp = BytesIO(qs)
             if headers is None:
@@ -403,11 +1544,16 @@ class FieldStorage:
             if 'CONTENT_LENGTH' in environ:
                 headers['content-length'] = environ['CONTENT_LENGTH']
         else:
-            if not (isinstance(headers, (Mapping, Message))):
-                raise TypeError("headers must be mapping or an instance of "
-                                "email.message.Message")
+            from collections.abc import Mapping
+            if not isinstance(headers, Mapping):
+                from email.message import Message
+                if not isinstance(headers, Message):
+                    raise TypeError("headers must be mapping or an instance "
+                                    "of email.message.Message")
         self.headers = headers
         if fp is None:
+            if isolated:
+                raise TypeError("fp is required when a ParserConfig is given")
             self.fp = sys.stdin.buffer
         # self.fp.read() must return bytes
         elif isinstance(fp, TextIOWrapper):
@@ -468,26 +1614,120 @@ class FieldStorage:
         else:
             self.innerboundary = b""
 
+        # The top-level request body, as opposed to a part of it or a GET
+        # query string, may be sent with transfer and content codings.
+        body = not self.outerboundary and method not in ('GET', 'HEAD')
+        chunked = body and _is_chunked(environ)
         clen = -1
-        if 'content-length' in self.headers:
+        if 'content-length' in self.headers and not chunked:
             try:
                 clen = int(self.headers['content-length'])
             except ValueError:
                 pass
-            if maxlen and clen > maxlen:
+            if config.maxlen and clen > config.maxlen:
                 raise ValueError('Maximum content length exceeded')
+
+        own_executor = processors and executor is None
+        if own_executor:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor()
+        self.executor = executor
+        fp = self.fp
+        pipeline = None
+        raw_input = None
+        self.input_stats = None
+        if body:
+            timeouts = (config.read_timeout is not None or
+                        config.body_timeout is not None)
+            if config.input_buffer_size:
+                deadline = None
+                if timeouts:
+                    deadline = _Deadline(_fileno(self.fp), config.read_timeout,
+                                         config.body_timeout)
+                raw_input = self.fp = _RawInput(self.fp, clen,
+                                                config.input_buffer_size,
+                                                deadline)
+            elif timeouts:
+                self.fp = _DeadlineReader(self.fp, clen, config.read_timeout,
+                                          config.body_timeout)
+            if config.pipeline_depth:
+                pipeline = self.fp = _PipelinedReader(self.fp, clen,
+                                                      config.pipeline_depth)
+            self.fp, clen = _decode_body(self.fp, environ, clen, config)
         self.length = clen
         if self.limit is None and clen >= 0:
             self.limit = clen
+        if self._progress is not None and not self.outerboundary:
+            self._progress.length = clen
 
         self.list = self.file = None
         self.done = 0
-        if ctype == 'application/x-www-form-urlencoded':
-            self.read_urlencoded()
-        elif ctype[:10] == 'multipart/':
-            self.read_multi(environ, keep_blank_values, strict_parsing)
-        else:
-            self.read_single()
+        try:
+            if ctype == 'application/x-www-form-urlencoded':
+                self.read_urlencoded()
+            elif ctype[:10] == 'multipart/':
+                self.read_multi(environ, keep_blank_values, strict_parsing)
+            else:
+                self.read_single()
+            if self._progress is not None and not self.outerboundary:
+                self._progress.report(self, True)
+            if processors and wait_processors:
+                self.wait_processors()
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+            if raw_input is not None:
+                self.input_stats = {'reads': raw_input.reads,
+                                    'bytes': raw_input.bytes}
+            if self.metrics is not None and not outerboundary:
+                self.metrics.bytes_read += self.bytes_read
+                self.metrics.total_time += self.metrics.clock() - start_time
+            self.fp = fp
+            if own_executor:
+                executor.shutdown(wait=wait_processors)
+                self.executor = None
+
+    @classmethod
+    def from_wsgi(cls, environ, *, config=None, **kwargs):
+        """Return the form of a WSGI request, parsing it only once.
+
+        The body is read from environ['wsgi.input'], never past
+        CONTENT_LENGTH.  Without a CONTENT_LENGTH it is read to EOF if
+        the server sets wsgi.input_terminated, and is otherwise taken to
+        be empty.  Any chunked transfer coding has been removed by the
+        server.  Nothing is taken from os.environ, sys.stdin or
+        sys.argv; config defaults to the limits in the module globals.
+
+        The form is stored in environ under "cgi.form", and later calls
+        return it whatever their arguments.  Other keyword arguments are
+        passed to the constructor.
+        """
+        form = environ.get('cgi.form')
+        if form is not None:
+            return form
+        if config is None:
+            # Settings given as arguments go into the config
+            names = vars(ParserConfig()).keys() - {'metrics'}
+            settings = {name: kwargs.pop(name) for name in list(kwargs)
+                        if name in names}
+            config = ParserConfig._from_globals(
+                metrics=bool(kwargs.get('metrics')), **settings)
+        fp = environ['wsgi.input']
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or -1)
+        except ValueError:
+            length = -1
+        if length >= 0:
+            fp = _LimitedReader(fp, length)
+        elif not environ.get('wsgi.input_terminated'):
+            fp = BytesIO()
+        request_environ = environ
+        if _is_chunked(environ):
+            request_environ = {key: value for key, value in environ.items()
+                               if key != 'HTTP_TRANSFER_ENCODING'}
+        form = cls(fp, environ=request_environ, config=config, **kwargs)
+        environ['cgi.form'] = form
+        return form
 
     def __del__(self):
         try:
@@ -499,7 +1739,72 @@ class FieldStorage:
         return self
 
     def __exit__(self, *args):
-        self.file.close()
+        self.close()
+
+    def close(self):
+        """Close the files of this part and of all the parts it contains.
+
+        Part processors still running are waited for first.  Calling
+        close() more than once is allowed.
+        """
+        items = [self]
+        for item in items:
+            if item.list:
+                items.extend(p for p in item.list
+                             if isinstance(p, FieldStorage))
+        futures = [f for item in items if item.futures
+                   for f in item.futures]
+        if futures:
+            from concurrent.futures import wait
+            wait(futures)
+        for item in items:
+            if item.file is not None:
+                item.file.close()
+
+    def send_fd(self, sock, extra=None):
+        """Pass the file of this part to another process over sock.
+
+        sock must be a connected Unix domain socket.  The file descriptor
+        is sent with SCM_RIGHTS together with a small JSON header
+        describing the part (name, filename, type, type_options, size,
+        binary and encoding), updated with the extra dictionary if given;
+        the receiving process gets both from recv_fd(), and reads the
+        same unlinked temporary file without a copy, from an offset of
+        its own.  A part held in memory is first written to a new
+        temporary file.
+        """
+        if self.file is None:
+            raise ValueError('Part %r has no file' % (self.name,))
+        try:
+            fd = self.file.fileno()
+        except (AttributeError, OSError):
+            fd = None
+        if fd is None:
+            import tempfile
+            value = self.value
+            if isinstance(value, str):
+                value = value.encode(self.encoding, self.errors)
+            spool = tempfile.TemporaryFile("wb+")
+            spool.write(value)
+            spool.seek(0)
+            try:
+                return self._send_fd(sock, spool, extra)
+            finally:
+                spool.close()
+        return self._send_fd(sock, self.file, extra)
+
+    def _send_fd(self, sock, file, extra):
+        file.flush()
+        file.seek(0)
+        fd = file.fileno()
+        meta = {'name': self.name, 'filename': self.filename,
+                'type': self.type, 'type_options': self.type_options,
+                'size': os.fstat(fd).st_size,
+                'binary': 'b' in getattr(file, 'mode', 'b'),
+                'encoding': self.encoding}
+        if extra:
+            meta.update(extra)
+        _send_message(sock, meta, [fd])
 
     def __repr__(self):
         """Return a printable representation."""
@@ -590,21 +1895,49 @@ class FieldStorage:
             raise TypeError("Cannot be converted to bool.")
         return bool(self.list)
 
+    def wait_processors(self):
+        """Wait for the part processors and store their results.
+
+        Every part in the tree gets a results list, in the same order as
+        the processors.  The first exception raised by a processor is
+        re-raised once all of them have finished.
+        """
+        from concurrent.futures import wait
+        items = [self]
+        for item in items:
+            if item.list:
+                items.extend(p for p in item.list
+                             if isinstance(p, FieldStorage))
+        parts = [item for item in items if item.futures is not None]
+        wait([f for part in parts for f in part.futures])
+        for part in parts:
+            part.results = [f.result() for f in part.futures]
+
     def read_urlencoded(self):
         """Internal: read data in query string format."""
+        metrics = self.metrics
+        if metrics is not None:
+            start = metrics.clock()
         qs = self.fp.read(self.length)
         if not isinstance(qs, bytes):
             raise ValueError("%s should return bytes, got %s" \
                              % (self.fp, type(qs).__name__))
+        if self._progress is not None:
+            self._progress.update(len(qs), self)
+        if metrics is not None:
+            metrics.bytes_read += len(qs)
         qs = qs.decode(self.encoding, self.errors)
         if self.qs_on_post:
             qs += '&' + self.qs_on_post
+        import urllib.parse
         query = urllib.parse.parse_qsl(
             qs, self.keep_blank_values, self.strict_parsing,
             encoding=self.encoding, errors=self.errors,
             max_num_fields=self.max_num_fields, separator=self.separator)
         self.list = [MiniFieldStorage(key, value) for key, value in query]
         self.skip_lines()
+        if metrics is not None:
+            metrics.scan_time += metrics.clock() - start
 
     FieldStorageClass = None
 
@@ -613,8 +1946,10 @@ class FieldStorage:
         ib = self.innerboundary
         if not valid_boundary(ib):
             raise ValueError('Invalid boundary in multipart form: %r' % (ib,))
+        from email.parser import FeedParser
         self.list = []
         if self.qs_on_post:
+            import urllib.parse
             query = urllib.parse.parse_qsl(
                 self.qs_on_post, self.keep_blank_values, self.strict_parsing,
                 encoding=self.encoding, errors=self.errors,
@@ -627,19 +1962,42 @@ class FieldStorage:
             raise ValueError("%s should return bytes, got %s" \
                              % (self.fp, type(first_line).__name__))
         self.bytes_read += len(first_line)
+        if self._progress is not None:
+            self._progress.update(len(first_line), self)
 
         # Ensure that we consume the file until we've hit our inner boundary
         while (first_line.strip() != (b"--" + self.innerboundary) and
                 first_line):
             first_line = self.fp.readline()
             self.bytes_read += len(first_line)
+            if self._progress is not None:
+                self._progress.update(len(first_line), self)
 
         # Propagate max_num_fields into the sub class appropriately
         max_num_fields = self.max_num_fields
         if max_num_fields is not None:
             max_num_fields -= len(self.list)
 
+        # Parts share the config of the form.  Only pass the options that
+        # are in use, so that a FieldStorageClass with the original
+        # constructor signature keeps working: without a config given by
+        # the caller, such a class gets the settings as arguments.
+        if self._isolated or klass.__init__ is FieldStorage.__init__:
+            settings = (('config', self.config),)
+        else:
+            settings = (('digests', self._digest_factories),
+                        ('verify_content_md5', self.verify_content_md5))
+        part_options = {name: value for name, value in settings + (
+            ('processors', self.processors),
+            ('progress', self._progress),
+            ('metrics', self.metrics)) if value}
+        if self.processors:
+            part_options.update(executor=self.executor,
+                                wait_processors=False)
+        metrics = self.metrics
         while True:
+            if metrics is not None:
+                start = metrics.clock()
             parser = FeedParser()
             hdr_text = b""
             while True:
@@ -651,8 +2009,13 @@ class FieldStorage:
                 break
             # parser takes strings, not bytes
             self.bytes_read += len(hdr_text)
+            if self._progress is not None:
+                self._progress.update(len(hdr_text), self)
             parser.feed(hdr_text.decode(self.encoding, self.errors))
             headers = parser.close()
+            if metrics is not None:
+                metrics.parts += 1
+                metrics.header_time += metrics.clock() - start
 
             # Some clients add Content-Length for part headers, ignore them
             if 'content-length' in headers:
@@ -662,7 +2025,8 @@ class FieldStorage:
                 else self.limit - self.bytes_read
             part = klass(self.fp, headers, ib, environ, keep_blank_values,
                          strict_parsing, limit,
-                         self.encoding, self.errors, max_num_fields, self.separator)
+                         self.encoding, self.errors, max_num_fields, self.separator,
+                         **part_options)
 
             if max_num_fields is not None:
                 max_num_fields -= 1
@@ -673,24 +2037,90 @@ class FieldStorage:
 
             self.bytes_read += part.bytes_read
             self.list.append(part)
+            if self.processors and part.filename is not None:
+                part.futures = [self.executor.submit(processor, part)
+                                for processor in self.processors]
             if part.done or self.bytes_read >= self.length > 0:
                 break
         self.skip_lines()
 
     def read_single(self):
         """Internal: read an atomic part."""
+        metrics = self.metrics
+        if metrics is not None:
+            start = metrics.clock()
+            write_time = metrics.write_time
+            self._bytes_written = 0
+        self._start_digests()
         if self.length >= 0:
             self.read_binary()
             self.skip_lines()
         else:
             self.read_lines()
+        if metrics is not None:
+            # Count the raw bytes, not the characters of a text file.
+            if self.__file is not None:
+                metrics.bytes_to_memory += self._bytes_written
+            else:
+                metrics.bytes_to_disk += self._bytes_written
         self.file.seek(0)
+        self._finish_digests()
+        if metrics is not None:
+            metrics.scan_time += (metrics.clock() - start -
+                                  (metrics.write_time - write_time))
+
+    def _start_digests(self):
+        """Internal: create the digest objects for an atomic part."""
+        objs = {}
+        for factory in self._digest_factories or ():
+            digest = _new_digest(factory)
+            objs[digest.name] = digest
+        self._md5_check = None
+        if self.verify_content_md5 and 'content-md5' in self.headers:
+            if 'md5' not in objs:
+                import hashlib
+                self._md5_check = hashlib.md5()
+                objs[None] = self._md5_check
+            else:
+                self._md5_check = objs['md5']
+        if objs:
+            self._digest_objs = objs
+
+    def _update_digests(self, data):
+        """Internal: feed a chunk of raw part data to the digests."""
+        for digest in self._digest_objs.values():
+            digest.update(data)
+
+    def _finish_digests(self):
+        """Internal: store the digest results, checking Content-MD5."""
+        objs = self._digest_objs
+        if objs is None:
+            return
+        self._digest_objs = None
+        if self._md5_check is not None:
+            import base64
+            import binascii
+            try:
+                expected = base64.b64decode(self.headers['content-md5'],
+                                            validate=True)
+            except binascii.Error:
+                raise ValueError('Invalid Content-MD5 header for part %r'
+                                 % (self.name,)) from None
+            if self._md5_check.digest() != expected:
+                raise ValueError('Content-MD5 mismatch for part %r'
+                                 % (self.name,))
+        if self._digest_factories:
+            self.digests = {name: digest.hexdigest()
+                            for name, digest in objs.items()
+                            if name is not None}
 
     bufsize = 8*1024            # I/O buffering size for copy to file
 
     def read_binary(self):
         """Internal: read binary data."""
-        self.file = self.make_file()
+        self.__file = None
+        self.file = self._make_part_file()
+        metrics = self.metrics
         todo = self.length
         if todo >= 0:
             while todo > 0:
@@ -699,10 +2129,20 @@ class FieldStorage:
                     raise ValueError("%s should return bytes, got %s"
                                      % (self.fp, type(data).__name__))
                 self.bytes_read += len(data)
+                if self._progress is not None:
+                    self._progress.update(len(data), self)
                 if not data:
                     self.done = -1
                     break
-                self.file.write(data)
+                if self._digest_objs is not None:
+                    self._update_digests(data)
+                if metrics is not None:
+                    start = metrics.clock()
+                    self.file.write(data)
+                    metrics.write_time += metrics.clock() - start
+                    self._bytes_written += len(data)
+                else:
+                    self.file.write(data)
                 todo = todo - len(data)
 
     def read_lines(self):
@@ -718,9 +2158,19 @@ class FieldStorage:
 
     def __write(self, line):
         """line is always bytes, not string"""
+        if self._digest_objs is not None:
+            self._update_digests(line)
+        metrics = self.metrics
+        timed = False
+        if metrics is not None:
+            metrics._writes += 1
+            self._bytes_written += len(line)
+            timed = not metrics._writes & 15
+            if timed:
+                start = metrics.clock()
         if self.__file is not None:
             if self.__file.tell() + len(line) > 1000:
-                self.file = self.make_file()
+                self.file = self._make_part_file()
                 data = self.__file.getvalue()
                 self.file.write(data)
                 self.__file = None
@@ -730,12 +2180,24 @@ class FieldStorage:
         else:
             # decode to string
             self.file.write(line.decode(self.encoding, self.errors))
+        if timed:
+            metrics.write_time += (metrics.clock() - start) * 16
+
+    def _make_part_file(self):
+        """Internal: make_file(), tracked and counted."""
+        file = self.make_file()
+        _track_file(file)
+        if self.metrics is not None:
+            self.metrics.files_created += 1
+        return file
 
     def read_lines_to_eof(self):
         """Internal: read lines until EOF."""
         while 1:
             line = self.fp.readline(1<<16) # bytes
             self.bytes_read += len(line)
+            if self._progress is not None:
+                self._progress.update(len(line), self)
             if not line:
                 self.done = -1
                 break
@@ -757,6 +2219,8 @@ class FieldStorage:
                 break
             line = self.fp.readline(1<<16) # bytes
             self.bytes_read += len(line)
+            if self._progress is not None:
+                self._progress.update(len(line), self)
             _read += len(line)
             if not line:
                 self.done = -1
@@ -801,6 +2265,8 @@ class FieldStorage:
         while True:
             line = self.fp.readline(1<<16)
             self.bytes_read += len(line)
+            if self._progress is not None:
+                self._progress.update(len(line), self)
             if not line:
                 self.done = -1
                 break
@@ -836,7 +2302,13 @@ class FieldStorage:
         terminates, try defining a __del__ method in a derived class
         which unlinks the temporary files you have created.
 
+        A file_factory in the ParserConfig, if any, is called with this
+        FieldStorage to make the file instead.
+
         """
+        if self.config.file_factory is not None:
+            return self.config.file_factory(self)
+        import tempfile
         if self._binary_file:
             return tempfile.TemporaryFile("wb+")
         else:
@@ -844,6 +2316,190 @@ class FieldStorage:
                 encoding=self.encoding, newline = '\n')
 
 
+class Request:
+
+    """A CGI request, parsed lazily.
+
+    Each of these attributes is computed the first time it is used, and
+    cached, so a request whose handler only needs a header or a query
+    parameter never reads the body:
+
+    query: dictionary mapping the names in QUERY_STRING to lists of
+        values, as returned by parse_qs()
+
+    form: FieldStorage for the request body and query string
+
+    files: dictionary mapping field names to lists of the uploaded file
+        parts (FieldStorage instances with a filename) of the form
+
+    cookies: dictionary mapping the cookie names in HTTP_COOKIE to their
+        values
+
+    headers: case-insensitive mapping of the request headers, a view of
+        the HTTP_* variables and CONTENT_TYPE and CONTENT_LENGTH
+
+    fp defaults to sys.stdin.buffer, which is only used if form or
+    files is.  config is a ParserConfig; by default its limits are
+    taken from the module globals.  Use the request as a context
+    manager, or call close(), to close the form's files, or, if the
+    body was never read, to discard it.
+    """
+
+    def __init__(self, environ=os.environ, fp=None, config=None):
+        if config is None:
+            config = ParserConfig._from_globals()
+        self.environ = environ
+        self.fp = fp
+        self.config = config
+        self._query = self._form = self._files = None
+        self._cookies = self._headers = None
+
+    @property
+    def query(self):
+        if self._query is None:
+            import urllib.parse
+            config = self.config
+            self._query = urllib.parse.parse_qs(
+                self.environ.get('QUERY_STRING', ''),
+                config.keep_blank_values, config.strict_parsing,
+                encoding=config.encoding, errors=config.errors,
+                max_num_fields=config.max_num_fields,
+                separator=config.separator)
+        return self._query
+
+    @property
+    def form(self):
+        if self._form is None:
+            fp = self.fp
+            if fp is None:
+                fp = sys.stdin.buffer
+            self._form = FieldStorage(fp, environ=self.environ,
+                                      config=self.config)
+        return self._form
+
+    @property
+    def files(self):
+        if self._files is None:
+            files = {}
+            stack = [(None, self.form)]
+            while stack:
+                name, part = stack.pop()
+                if isinstance(part, MiniFieldStorage):
+                    continue
+                name = part.name or name
+                if part.filename is not None:
+                    files.setdefault(name, []).append(part)
+                elif part.list:
+                    stack.extend((name, item) for item in reversed(part.list))
+            self._files = files
+        return self._files
+
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            import http.cookies
+            cookie = http.cookies.SimpleCookie()
+            try:
+                cookie.load(self.environ.get('HTTP_COOKIE', ''))
+            except http.cookies.CookieError:
+                pass
+            self._cookies = {name: morsel.value
+                             for name, morsel in cookie.items()}
+        return self._cookies
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = _EnvironHeaders(self.environ)
+        return self._headers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the form's files, or discard the body if it was not read."""
+        if self._form is not None:
+            self._form.close()
+            return
+        method = self.environ.get('REQUEST_METHOD', 'GET').upper()
+        try:
+            todo = int(self.environ.get('CONTENT_LENGTH', 0))
+        except ValueError:
+            return
+        if method in ('GET', 'HEAD') or todo <= 0:
+            return
+        fp = self.fp
+        if fp is None:
+            fp = sys.stdin.buffer
+        # Reading into one buffer allocates nothing per chunk
+        buf = memoryview(bytearray(min(todo, 1 << 16)))
+        readinto = getattr(fp, 'readinto', None)
+        while todo > 0:
+            if readinto is not None:
+                n = readinto(buf[:todo])
+            else:
+                n = len(fp.read(min(todo, len(buf))))
+            if not n:
+                break
+            todo -= n
+
+    def __repr__(self):
+        return 'Request(%s %s)' % (self.environ.get('REQUEST_METHOD', 'GET'),
+                                   self.environ.get('SCRIPT_NAME', '') +
+                                   self.environ.get('PATH_INFO', ''))
+
+
+class _EnvironHeaders:
+
+    """Case-insensitive read-only mapping of the headers in a CGI environ."""
+
+    _unprefixed = ('CONTENT_TYPE', 'CONTENT_LENGTH')
+
+    def __init__(self, environ):
+        self._environ = environ
+
+    def _key(self, name):
+        key = name.upper().replace('-', '_')
+        if key in self._unprefixed:
+            return key
+        return 'HTTP_' + key
+
+    def __getitem__(self, name):
+        return self._environ[self._key(name)]
+
+    def get(self, name, default=None):
+        return self._environ.get(self._key(name), default)
+
+    def __contains__(self, name):
+        return isinstance(name, str) and self._key(name) in self._environ
+
+    def __iter__(self):
+        for key in self._environ:
+            if key.startswith('HTTP_'):
+                key = key[5:]
+            elif key not in self._unprefixed:
+                continue
+            yield '-'.join(word.capitalize() for word in key.split('_'))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def __repr__(self):
+        return '<headers %r>' % dict(self.items())
+
+
 # Test/debug code
 # ===============
 
@@ -889,6 +2545,7 @@ def test(environ=os.environ):
 def print_exception(type=None, value=None, tb=None, limit=None):
     if type is None:
         type, value, tb = sys.exc_info()
+    import html
     import traceback
     print()
     print("<H3>Traceback (most recent call last):</H3>")
@@ -902,6 +2559,7 @@ def print_exception(type=None, value=None, tb=None, limit=None):
 
 def print_environ(environ=os.environ):
     """Dump the shell environment as HTML."""
+    import html
     keys = sorted(environ.keys())
     print()
     print("<H3>Shell Environment:</H3>")
@@ -913,6 +2571,7 @@ def print_environ(environ=os.environ):
 
 def print_form(form):
     """Dump the contents of a form as HTML."""
+    import html
     keys = sorted(form.keys())
     print()
     print("<H3>Form Contents:</H3>")
@@ -929,6 +2588,7 @@ def print_form(form):
 
 def print_directory():
     """Dump the current directory as HTML."""
+    import html
     print()
     print("<H3>Current Working Directory:</H3>")
     try:
@@ -990,20 +2650,1564 @@ environment as well.  Here are some common variable names:
 """)
 
 
+# The profiler started by enable_profiling() in this process
+_profiler = None
+
+def enable_profiling(directory, sample_rate=1.0, environ=os.environ):
+    """Profile this request with cProfile, for a fraction of requests.
+
+    With probability sample_rate, start a cProfile.Profile and return
+    it; when the process exits, its statistics are written to a file in
+    directory named after the request id (UNIQUE_ID, HTTP_X_REQUEST_ID,
+    or else the time and process id) and the request path.  Otherwise,
+    or if another profiler is already active, return None, having done
+    nothing else.  If this function already started a profiler in this
+    process, return that one.
+
+    This is called when cgi is imported if the CGI_PROFILE_DIR
+    environment variable is set, with sample_rate taken from
+    CGI_PROFILE_RATE.
+    """
+    global _profiler
+    if _profiler is not None:
+        return _profiler
+    if sample_rate < 1:
+        # Not the random module, whose import would cost unsampled
+        # requests more than the rest of this function
+        if int.from_bytes(os.urandom(4), 'big') >= sample_rate * (1 << 32):
+            return None
+    import atexit
+    import cProfile
+    filename = _request_filename(directory, environ, '.prof')
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiling tool is already active
+        return None
+    atexit.register(_dump_profile, profiler, filename)
+    _profiler = profiler
+    return profiler
+
+def _dump_profile(profiler, filename):
+    profiler.disable()
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        profiler.dump_stats(tmp)
+        os.replace(tmp, filename)
+    except OSError:
+        pass
+
+def _request_filename(directory, environ, suffix):
+    """Return a file name in directory for this request, ending in suffix."""
+    import time
+    request_id = (environ.get('UNIQUE_ID') or
+                  environ.get('HTTP_X_REQUEST_ID') or
+                  '%d-%d' % (time.time(), os.getpid()))
+    path = (environ.get('SCRIPT_NAME', '') +
+            environ.get('PATH_INFO', '')).strip('/')
+    name = _safe_filename('%s-%s' % (request_id, path.replace('/', '.')))
+    return os.path.join(directory, name + suffix)
+
+# The environment variables kept in a capture: what the parser reads and
+# what identifies the request, but no cookies or credentials
+_CAPTURE_ENVIRON = ('REQUEST_METHOD', 'QUERY_STRING', 'CONTENT_TYPE',
+                    'CONTENT_LENGTH', 'HTTP_TRANSFER_ENCODING',
+                    'HTTP_CONTENT_ENCODING', 'SCRIPT_NAME', 'PATH_INFO',
+                    'SERVER_PROTOCOL', 'UNIQUE_ID', 'HTTP_X_REQUEST_ID')
+
+_CAPTURE_MAGIC = b'CGICAPTURE 1\n'
+
+# The recorder of this process, set by enable_recording()
+_recorder = None
+
+class _Recorder:
+
+    """Keep what is read from standard input, and the parse metrics."""
+
+    def __init__(self, filename, environ, max_body):
+        import time
+        self.filename = filename
+        self.environ = {name: environ[name] for name in _CAPTURE_ENVIRON
+                        if name in environ}
+        self.max_body = max_body
+        self.body = bytearray()
+        self.body_size = 0
+        self.metrics = ParseMetrics()
+        self.start = time.perf_counter()
+
+    def add(self, data):
+        self.body_size += len(data)
+        keep = len(data)
+        if self.max_body is not None:
+            keep = min(keep, self.max_body - len(self.body))
+        if keep > 0:
+            self.body += data[:keep]
+
+    def write(self):
+        import time
+        info = {'body_size': self.body_size,
+                'truncated': len(self.body) < self.body_size,
+                'metrics': self.metrics.as_dict(),
+                'elapsed': time.perf_counter() - self.start,
+                'time': time.time()}
+        try:
+            _write_capture(self.filename, self.environ, self.body, info)
+        except OSError:
+            pass
+
+class _RecordingInput(RawIOBase):
+
+    """Read from fp, passing all data read to a _Recorder.
+
+    It has no file descriptor, so the parser reads through it instead of
+    reading standard input directly.
+    """
+
+    def __init__(self, fp, recorder):
+        self.fp = fp
+        self.recorder = recorder
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.fp.read1(len(b))
+        b[:len(data)] = data
+        self.recorder.add(data)
+        return len(data)
+
+def enable_recording(directory, sample_rate=1.0, max_body=None,
+                     environ=os.environ):
+    """Record this request to a capture file, for a fraction of requests.
+
+    With probability sample_rate, replace sys.stdin with a stream that
+    keeps a copy of the request body as it is read, at most max_body
+    bytes of it if max_body is not None, and have FieldStorage collect
+    ParseMetrics for the request.  When the process exits, the CGI
+    variables of environ that the parser uses, the body and the metrics
+    are written to a capture file in directory, named like the profiles
+    of enable_profiling() with a .cgicapture suffix, which replay() and
+    "python -m cgi replay" read.  Return the name of the capture file,
+    or None if this request is not recorded.
+
+    This is called when cgi is imported if the CGI_RECORD_DIR
+    environment variable is set, with sample_rate and max_body taken
+    from CGI_RECORD_RATE and CGI_RECORD_MAX_BODY.
+    """
+    global _recorder
+    if _recorder is not None:
+        return _recorder.filename
+    if sample_rate < 1:
+        if int.from_bytes(os.urandom(4), 'big') >= sample_rate * (1 << 32):
+            return None
+    import atexit
+    from io import BufferedReader
+    filename = _request_filename(directory, environ, '.cgicapture')
+    _recorder = _Recorder(filename, environ, max_body)
+    stdin = sys.stdin
+    if stdin is not None:
+        sys.stdin = TextIOWrapper(
+            BufferedReader(_RecordingInput(stdin.buffer, _recorder)),
+            encoding=stdin.encoding, errors=stdin.errors)
+    atexit.register(_recorder.write)
+    return filename
+
+def _write_capture(filename, environ, body, info):
+    """Write a capture file: a magic line, a JSON header line, the body.
+
+    The body is compressed with zlib; the header holds the environ, the
+    other items of info and the compressed size.
+    """
+    import json
+    import zlib
+    data = zlib.compress(body)
+    header = dict(info, environ=environ, compressed_size=len(data))
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'wb') as f:
+        f.write(_CAPTURE_MAGIC)
+        f.write(json.dumps(header, sort_keys=True).encode('ascii') + b'\n')
+        f.write(data)
+    os.replace(tmp, filename)
+
+def _read_capture(filename):
+    """Return the environ, body and header of a capture file."""
+    import json
+    import zlib
+    with open(filename, 'rb') as f:
+        if f.readline() != _CAPTURE_MAGIC:
+            raise ValueError('%s is not a capture file' % filename)
+        header = json.loads(f.readline())
+        body = zlib.decompress(f.read())
+    return header.pop('environ'), body, header
+
+def replay(filename, api='FieldStorage', repeat=1, profiler=None):
+    """Parse the request in a capture file repeat times.
+
+    The body is parsed from memory with FieldStorage, or with parse() if
+    api is 'parse', using the environ of the capture and a default
+    ParserConfig, so that nothing is taken from this process's
+    environment.  Files created for the parts are closed after each
+    parse.  If profiler is given, such as a cProfile.Profile, it is
+    enabled during the parses only.  Return the duration of each parse
+    in seconds.
+
+    A truncated body is replayed as it is, like a request whose client
+    went away early.
+    """
+    import time
+    if api not in ('FieldStorage', 'parse'):
+        raise ValueError('api must be FieldStorage or parse, not %r'
+                         % (api,))
+    environ, body, header = _read_capture(filename)
+    times = []
+    for _ in range(repeat):
+        fp = BytesIO(body)
+        config = ParserConfig()
+        if profiler is not None:
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            if api == 'parse':
+                parse(fp, environ, config=config)
+            else:
+                FieldStorage(fp, environ=environ, config=config).close()
+        finally:
+            times.append(time.perf_counter() - start)
+            if profiler is not None:
+                profiler.disable()
+    return times
+
 # Utilities
 # =========
 
+def _safe_filename(name):
+    """Return str(name) with characters unsafe in a file name replaced."""
+    return ''.join(c if c.isalnum() or c in '-_.@' else '_'
+                   for c in str(name)).lstrip('.')
+
+# Files returned by make_file() that have not been garbage collected yet,
+# added to and counted under _files_lock as forms may be parsed in
+# several threads
+_files = _WeakSet()
+_files_lock = _thread.allocate_lock()
+
+def _track_file(f):
+    try:
+        with _files_lock:
+            _files.add(f)
+    except TypeError:
+        pass
+
+def recv_fd(sock):
+    """Receive a part file sent with FieldStorage.send_fd().
+
+    Return a (metadata, file) tuple, where file is opened for reading in
+    binary mode from the start of the part data.  The file has its own
+    offset, so reading it does not move the sender's position.
+    """
+    from io import BufferedReader
+    meta, fds = _recv_message(sock, 1)
+    fd = fds[0]
+    try:
+        # A received descriptor shares its offset with the sender's;
+        # opening it again gives an independent one (Linux)
+        new = os.open('/proc/self/fd/%d' % fd, os.O_RDONLY)
+    except OSError:
+        return meta, BufferedReader(_PositionalReader(fd))
+    os.close(fd)
+    return meta, os.fdopen(new, 'rb')
+
+class _PositionalReader(RawIOBase):
+
+    """Read a file descriptor with os.pread() from an offset of its own."""
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = os.pread(self._fd, len(b), self._pos)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += os.fstat(self._fd).st_size
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+def _send_message(sock, obj, fds):
+    """Send obj as length-prefixed JSON, with file descriptors fds."""
+    import json
+    import socket
+    import struct
+    data = json.dumps(obj).encode('utf-8')
+    data = struct.pack('!I', len(data)) + data
+    sent = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                  struct.pack('%di' % len(fds), *fds))])
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+def _recv_message(sock, count):
+    """Receive (obj, fds) sent by _send_message() with count fds."""
+    import json
+    import socket
+    import struct
+    size = struct.calcsize('i')
+    data, ancdata, flags, addr = sock.recvmsg(1 << 16,
+                                              socket.CMSG_SPACE(count * size))
+    fds = []
+    for level, type, cdata in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            n = len(cdata) // size
+            fds.extend(struct.unpack('%di' % n, cdata[:n * size]))
+    try:
+        if len(fds) != count:
+            raise ValueError('Expected %d file descriptors, got %d'
+                             % (count, len(fds)))
+        while len(data) < 4 or len(data) < 4 + struct.unpack('!I',
+                                                              data[:4])[0]:
+            more = sock.recv(1 << 16)
+            if not more:
+                raise ValueError('Incomplete file descriptor header')
+            data += more
+        length, = struct.unpack('!I', data[:4])
+        obj = json.loads(data[4:4 + length].decode('utf-8'))
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return obj, fds
+
+def open_file_count():
+    """Return the number of files from make_file() that are still open."""
+    with _files_lock:
+        files = list(_files)
+    return sum(1 for f in files if not f.closed)
+
+class _Checksum:
+
+    """Adapt a zlib checksum function to the hashlib digest interface."""
+
+    def __init__(self, func):
+        self.name = func.__name__
+        self._func = func
+        self._value = func(b"")
+
+    def update(self, data):
+        self._value = self._func(data, self._value)
+
+    def digest(self):
+        return self._value.to_bytes(4, 'big')
+
+    def hexdigest(self):
+        return '%08x' % self._value
+
+def _new_digest(factory):
+    """Return a new digest object from a hashlib or zlib factory."""
+    import zlib
+    if factory is zlib.crc32 or factory is zlib.adler32:
+        return _Checksum(factory)
+    return factory()
+
+_vb_patterns = {}
+
 def valid_boundary(s):
-    import re
-    if isinstance(s, bytes):
-        _vb_pattern = b"^[ -~]{0,200}[!-~]$"
+    binary = isinstance(s, bytes)
+    try:
+        pattern = _vb_patterns[binary]
+    except KeyError:
+        import re
+        if binary:
+            _vb_pattern = b"^[ -~]{0,200}[!-~]$"
+        else:
+            _vb_pattern = "^[ -~]{0,200}[!-~]$"
+        pattern = _vb_patterns[binary] = re.compile(_vb_pattern)
+    return pattern.match(s)
+
+# Names that were imported at module level before imports were deferred
+_lazy_names = {
+    'Mapping': ('collections.abc', 'Mapping'),
+    'FeedParser': ('email.parser', 'FeedParser'),
+    'Message': ('email.message', 'Message'),
+    'html': ('html', None),
+    'locale': ('locale', None),
+    'tempfile': ('tempfile', None),
+    'urllib': ('urllib.parse', None),
+    'warnings': ('warnings', None),
+}
+
+def __getattr__(name):
+    try:
+        module, attr = _lazy_names[name]
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r"
+                             % (__name__, name)) from None
+    import importlib
+    value = importlib.import_module(module)
+    if attr is not None:
+        return getattr(value, attr)
+    # "import urllib.parse" bound the top-level package
+    return importlib.import_module(name)
+
+# Script runners
+# ==============
+#
+# "python -m cgi serve-workers" keeps a pool of warm worker processes
+# that run the scripts of a cgi-bin directory without starting a new
+# interpreter per request.  As with FastCGI, a request and its response
+# are sent as records over a Unix domain socket, each a type byte and a
+# 4-byte payload length followed by the payload: one PARAMS record with
+# the script name and CGI environment as JSON, STDIN records with the
+# body, ended by an empty one, then STDOUT and STDERR records with the
+# output and an END record with the exit status.
+
+_PARAMS, _STDIN, _STDOUT, _STDERR, _END = range(1, 6)
+
+_RECORD_SIZE = 1 << 16          # largest payload written at once
+
+def _send_record(sock, type, data=b''):
+    import struct
+    sock.sendall(struct.pack('!BI', type, len(data)))
+    if data:
+        sock.sendall(data)
+
+def _recv_exactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while view:
+        got = sock.recv_into(view)
+        if not got:
+            raise EOFError('Connection closed in the middle of a record')
+        view = view[got:]
+    return bytes(buf)
+
+def _recv_record(sock):
+    """Return (type, payload), or (None, b'') at end of stream."""
+    import struct
+    first = sock.recv(1)
+    if not first:
+        return None, b''
+    type, length = struct.unpack('!BI', first + _recv_exactly(sock, 4))
+    return type, _recv_exactly(sock, length) if length else b''
+
+
+class _RecordInput(RawIOBase):
+
+    """Raw stream reading the STDIN records of a request."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._data = b''
+        self._pos = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._data):
+            if self.eof:
+                return 0
+            type, data = _recv_record(self._sock)
+            if type is None:
+                raise EOFError('Connection closed before end of input')
+            if type != _STDIN:
+                raise ValueError('Unexpected record type %d' % type)
+            if not data:
+                self.eof = True
+            self._data, self._pos = data, 0
+        n = min(len(b), len(self._data) - self._pos)
+        b[:n] = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def drain(self):
+        """Read and discard the rest of the input."""
+        while not self.eof:
+            self._pos = len(self._data)
+            self.readinto(bytearray(1))
+
+
+class _RecordOutput(RawIOBase):
+
+    """Raw stream writing its data as records of one type."""
+
+    def __init__(self, sock, type):
+        self._sock = sock
+        self._type = type
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        data = bytes(b)
+        for start in range(0, len(data), _RECORD_SIZE):
+            _send_record(self._sock, self._type,
+                         data[start:start + _RECORD_SIZE])
+        return len(data)
+
+
+def _load_script(cache, path):
+    """Return the code object of a script, compiled again if it changed."""
+    mtime = os.stat(path).st_mtime_ns
+    entry = cache.get(path)
+    if entry is None or entry[0] != mtime:
+        with open(path, 'rb') as f:
+            source = f.read()
+        entry = cache[path] = (mtime, compile(source, path, 'exec'))
+    return entry[1]
+
+# Module globals a script may change, restored after each request
+_script_globals = ('maxlen', 'max_decompressed_size', 'max_compression_ratio',
+                   'logfile', 'logfp', 'log')
+
+def _run_script(code, path, environ, stdin, stdout, stderr):
+    """Run a compiled script as a CGI process would; return exit status.
+
+    The process environment, sys.argv, standard streams, exception hook,
+    sys.path, working directory and this module's settings are those of
+    the request while the script runs, and restored afterwards.
+    """
+    import builtins
+    module = globals()
+    saved_environ = dict(os.environ)
+    saved_cwd = os.getcwd()
+    saved_sys = (sys.argv, sys.stdin, sys.stdout, sys.stderr, sys.excepthook,
+                 sys.path[:])
+    saved_module = {name: module[name] for name in _script_globals}
+    os.environ.clear()
+    os.environ.update(environ)
+    sys.argv = [path]
+    sys.path.insert(0, os.path.dirname(path))
+    sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+    status = 0
+    try:
+        os.chdir(os.path.dirname(path))
+        exec(code, {'__name__': '__main__', '__file__': path,
+                    '__builtins__': builtins})
+    except SystemExit as exc:
+        if exc.code is None:
+            status = 0
+        elif isinstance(exc.code, int):
+            status = exc.code
+        else:
+            print(exc.code, file=sys.stderr)
+            status = 1
+    except BaseException:
+        sys.excepthook(*sys.exc_info())
+        status = 1
+    finally:
+        for stream in (stdout, stderr):
+            try:
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        os.chdir(saved_cwd)
+        (sys.argv, sys.stdin, sys.stdout, sys.stderr, sys.excepthook,
+         sys.path[:]) = saved_sys
+        module.update(saved_module)
+    return status
+
+def _script_path(cgi_dir, script):
+    """Return the path of script in cgi_dir, or None if not found there."""
+    cgi_dir = os.path.realpath(cgi_dir)
+    path = os.path.realpath(os.path.join(cgi_dir, script.lstrip('/')))
+    if not path.startswith(cgi_dir + os.sep) or not os.path.isfile(path):
+        return None
+    return path
+
+def _script_command(path):
+    """Internal: return the command line running the script at path."""
+    if path.endswith('.py'):
+        return [sys.executable, path]
+    return [path]
+
+def _worker_request(conn, cgi_dir, cache):
+    """Internal: handle one request on a worker connection."""
+    import json
+    import struct
+    type, data = _recv_record(conn)
+    if type is None:
+        return
+    if type != _PARAMS:
+        raise ValueError('Expected a PARAMS record, got %d' % type)
+    params = json.loads(data.decode('utf-8'))
+    stdin = _RecordInput(conn)
+    path = _script_path(cgi_dir, params['script'])
+    if path is None:
+        _send_record(conn, _STDERR, b'No such script: %s\n'
+                     % params['script'].encode('utf-8', 'replace'))
+        status = 127
     else:
-        _vb_pattern = "^[ -~]{0,200}[!-~]$"
-    return re.match(_vb_pattern, s)
+        try:
+            code = _load_script(cache, path)
+        except (OSError, SyntaxError, ValueError) as exc:
+            _send_record(conn, _STDERR, ('%s: %s\n' % (path, exc)).encode(
+                'utf-8', 'replace'))
+            status = 1
+        else:
+            status = _run_script(
+                code, path, params['environ'],
+                TextIOWrapper(BufferedReader(stdin), encoding='utf-8',
+                              errors='surrogateescape'),
+                TextIOWrapper(BufferedWriter(_RecordOutput(conn, _STDOUT),
+                                             _RECORD_SIZE),
+                              encoding='utf-8'),
+                TextIOWrapper(BufferedWriter(_RecordOutput(conn, _STDERR)),
+                              encoding='utf-8', errors='backslashreplace',
+                              line_buffering=True))
+    stdin.drain()
+    _send_record(conn, _END, struct.pack('!i', status))
+
+def _worker_loop(listener, cgi_dir, max_requests):
+    """Internal: accept and handle requests in a worker process."""
+    cache = {}
+    handled = 0
+    while not max_requests or handled < max_requests:
+        conn, addr = listener.accept()
+        with conn:
+            try:
+                _worker_request(conn, cgi_dir, cache)
+            except (OSError, EOFError, ValueError):
+                pass        # the client went away or spoke nonsense
+        handled += 1
+
+def serve_workers(address, cgi_dir, workers=4, max_requests=0, ready=None):
+    """Run the scripts in cgi_dir in a pool of preforked worker processes.
+
+    Listen on the Unix domain socket at address and fork workers that
+    each accept requests, run the script named in the request with its
+    own environment, standard input and output, and reset the process
+    afterwards.  Scripts are compiled once and again only when their
+    modification time changes.  A worker that dies, for example because
+    a script called os._exit(), is replaced; with max_requests, workers
+    are also replaced after handling that many requests.  ready, if
+    given, is called once the socket is listening.  Runs until
+    interrupted with SIGINT or SIGTERM.
+    """
+    import signal
+    import socket
+    import cgitb        # imported by most scripts; load it once for all
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.unlink(address)
+    except FileNotFoundError:
+        pass
+    listener.bind(address)
+    listener.listen(128)
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                _worker_loop(listener, cgi_dir, max_requests)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        children.add(pid)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    previous = signal.signal(signal.SIGTERM, stop)
+    try:
+        for _ in range(workers):
+            spawn()
+        if ready is not None:
+            ready()
+        while True:
+            pid, status = os.wait()
+            if pid in children:
+                children.discard(pid)
+                spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        listener.close()
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+
+def _call_worker(address, script, environ, body=b''):
+    """Internal: run script through serve_workers() at address.
+
+    Return (status, stdout, stderr); status is None if the worker died
+    before finishing the request.
+    """
+    import json
+    import socket
+    import struct
+    import threading
+    stdout = []
+    stderr = []
+    status = None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        params = {'script': script, 'environ': dict(environ)}
+        _send_record(sock, _PARAMS, json.dumps(params).encode('utf-8'))
+
+        def send_body():
+            try:
+                for start in range(0, len(body), _RECORD_SIZE):
+                    _send_record(sock, _STDIN,
+                                 body[start:start + _RECORD_SIZE])
+                _send_record(sock, _STDIN)
+            except OSError:
+                pass
+        # Send the body while reading the output, so that neither side
+        # blocks on a full socket buffer
+        sender = threading.Thread(target=send_body, daemon=True)
+        sender.start()
+        try:
+            while True:
+                type, data = _recv_record(sock)
+                if type is None:
+                    break
+                if type == _STDOUT:
+                    stdout.append(data)
+                elif type == _STDERR:
+                    stderr.append(data)
+                elif type == _END:
+                    status, = struct.unpack('!i', data)
+                    break
+        except (OSError, EOFError):
+            pass
+        sender.join()
+    return status, b''.join(stdout), b''.join(stderr)
+
+
+# "python -m cgi serve-fork" is for scripts that cannot share a process
+# between requests: a parent process imports the modules they use once,
+# and forks a child per request.  The client sends the script name and
+# environ with _send_message(), along with the file descriptors to use as
+# the child's standard input, output and error, and gets the exit status
+# back as a 4-byte signed integer, negative for a signal.
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _fork_child(code, path, environ, fds):
+    """Internal: run a script in a forked child; never returns."""
+    import atexit
+    import signal
+    status = 1
+    try:
+        for signum in (signal.SIGCHLD, signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        for fd in set(fds):
+            if fd > 2:
+                os.close(fd)
+        # The parent's exit functions are not this request's.  There is
+        # no public API for this: atexit._clear() and _run_exitfuncs()
+        # have been there since Python 3.0, but are private.
+        atexit._clear()
+        stdin = open(0, 'r', closefd=False)
+        stdout = open(1, 'w', closefd=False)
+        stderr = open(2, 'w', closefd=False, errors='backslashreplace',
+                      buffering=1)
+        status = _run_script(code, path, environ, stdin, stdout, stderr)
+        sys.stdout, sys.stderr = stdout, stderr
+        atexit._run_exitfuncs()
+        stdout.flush()
+    finally:
+        os._exit(status)
+
+def serve_fork(address, cgi_dir, preload=(), ready=None):
+    """Fork a process per request from a parent with modules preloaded.
+
+    Import cgi, cgitb and the modules named in preload, freeze the
+    objects they created with gc.freeze() so that children do not
+    copy the memory pages holding them, and listen on the Unix domain
+    socket at address.  For each request, fork a child that runs the
+    script named in the request, from cgi_dir, with the request's
+    environment and the standard input, output and error passed with
+    it, then send the child's exit status back.  ready, if given, is
+    called once the socket is listening.  Runs until interrupted with
+    SIGINT or SIGTERM.
+    """
+    import gc
+    import importlib
+    import selectors
+    import signal
+    import socket
+    import struct
+    import cgitb
+    for name in preload:
+        importlib.import_module(name)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.unlink(address)
+    except FileNotFoundError:
+        pass
+    listener.bind(address)
+    listener.listen(128)
+    # SIGCHLD wakes up the loop through this pipe
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(wakeup_r, selectors.EVENT_READ)
+    cache = {}
+    # Connections whose request has not been read yet
+    pending = set()
+    running = {}
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    def start(conn):
+        # Only called once conn is readable, so the request has started
+        # to arrive; the timeout bounds waiting for the rest of it.
+        conn.settimeout(1)
+        request, fds = _recv_message(conn, 3)
+        try:
+            path = _script_path(cgi_dir, request['script'])
+            if path is None:
+                os.write(fds[2], b'No such script: %s\n'
+                         % request['script'].encode('utf-8', 'replace'))
+                conn.sendall(struct.pack('!i', 127))
+                return False
+            code = _load_script(cache, path)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                listener.close()
+                for other in pending:
+                    other.close()
+                for other in running.values():
+                    other.close()
+                conn.close()
+                _fork_child(code, path, request['environ'], fds)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        running[pid] = conn
+        return True
+
+    previous = {signum: signal.signal(signum, handler) for signum, handler
+                in ((signal.SIGTERM, stop),
+                    (signal.SIGCHLD, lambda signum, frame: None))}
+    previous_wakeup = signal.set_wakeup_fd(wakeup_w)
+    gc.collect()
+    gc.freeze()
+    try:
+        if ready is not None:
+            ready()
+        while True:
+            for key, events in selector.select():
+                if key.fileobj is listener:
+                    conn, addr = listener.accept()
+                    selector.register(conn, selectors.EVENT_READ)
+                    pending.add(conn)
+                    continue
+                if key.fileobj in pending:
+                    conn = key.fileobj
+                    selector.unregister(conn)
+                    pending.discard(conn)
+                    try:
+                        if start(conn):
+                            continue
+                    except (OSError, ValueError, KeyError, SyntaxError):
+                        pass
+                    conn.close()
+                    continue
+                try:
+                    while os.read(wakeup_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                while running:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                    if not pid:
+                        break
+                    conn = running.pop(pid, None)
+                    if conn is not None:
+                        with conn:
+                            try:
+                                conn.sendall(struct.pack('!i',
+                                                         _exit_code(status)))
+                            except OSError:
+                                pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.set_wakeup_fd(previous_wakeup)
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        gc.unfreeze()
+        for pid, conn in running.items():
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            conn.close()
+        for conn in pending:
+            conn.close()
+        selector.close()
+        listener.close()
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+
+def _call_fork_server(address, script, environ, stdin, stdout, stderr):
+    """Internal: run script through serve_fork() at address.
+
+    stdin, stdout and stderr are file descriptors for the child.  Return
+    its exit status, negative for a signal, or None if the server went
+    away.
+    """
+    import socket
+    import struct
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        _send_message(sock, {'script': script, 'environ': dict(environ)},
+                      [stdin, stdout, stderr])
+        try:
+            status, = struct.unpack('!i', _recv_exactly(sock, 4))
+        except EOFError:
+            return None
+    return status
+
+
+# "python -m cgi serve" is a small threaded HTTP server running the
+# scripts of a cgi-bin directory as CGI processes, for development and as
+# a local target for load tests.  Request bodies are streamed to the
+# script's standard input and its output back to the client as it comes.
+
+def _make_request_handler(cgi_dir, prefix, slots, queue_timeout, timeout):
+    """Internal: return the request handler class used by serve()."""
+    import http.server
+    import socket
+    import subprocess
+    import threading
+    import time
+
+    class CGIRequestHandler(http.server.BaseHTTPRequestHandler):
+
+        server_version = 'cgi.py'
+
+        def do_GET(self):
+            self.run_cgi()
+
+        do_POST = do_PUT = do_DELETE = do_PATCH = do_HEAD = do_GET
+
+        def log_request(self, code='-', size='-'):
+            # run_cgi() logs its own line, with the timings
+            pass
+
+        def find_script(self):
+            """Return (script path, SCRIPT_NAME, PATH_INFO, QUERY_STRING)."""
+            import urllib.parse
+            path, _, query = self.path.partition('?')
+            path = urllib.parse.unquote(path)
+            if not path.startswith(prefix + '/'):
+                return None, None, None, query
+            rest = path[len(prefix) + 1:]
+            name, slash, path_info = rest.partition('/')
+            script = _script_path(cgi_dir, name)
+            return (script, prefix + '/' + name,
+                    slash + path_info if slash else '', query)
+
+        def cgi_environ(self, script_name, path_info, query):
+            env = {name: value for name, value in os.environ.items()
+                   if not name.startswith('HTTP_')
+                   and name not in ('CONTENT_TYPE', 'CONTENT_LENGTH')}
+            env.update({
+                'SERVER_SOFTWARE': self.version_string(),
+                'SERVER_NAME': self.server.server_name,
+                'SERVER_PORT': str(self.server.server_port),
+                'SERVER_PROTOCOL': self.protocol_version,
+                'GATEWAY_INTERFACE': 'CGI/1.1',
+                'REQUEST_METHOD': self.command,
+                'SCRIPT_NAME': script_name,
+                'PATH_INFO': path_info,
+                'QUERY_STRING': query,
+                'REMOTE_ADDR': self.client_address[0],
+                'UNIQUE_ID': os.urandom(12).hex(),
+            })
+            for name, value in self.headers.items():
+                key = name.upper().replace('-', '_')
+                if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                    env[key] = value
+                elif key != 'PROXY':     # see httpoxy
+                    key = 'HTTP_' + key
+                    if key in env:
+                        env[key] += ', ' + value
+                    else:
+                        env[key] = value
+            return env
+
+        def copy_body(self, stdin, length, exited):
+            """Copy the request body to the script's standard input.
+
+            length is the body size, or -1 for a chunked body.  Stop
+            once the event exited is set.
+            """
+            try:
+                if length < 0:
+                    body = _ChunkedReader(self.rfile)
+                else:
+                    body = self.rfile
+                todo = length
+                while todo and not exited.is_set():
+                    data = body.read(1 << 16 if todo < 0
+                                     else min(todo, 1 << 16))
+                    if not data or exited.is_set():
+                        break
+                    stdin.write(data)
+                    todo -= len(data)
+            except (OSError, ValueError):
+                pass
+            finally:
+                try:
+                    stdin.close()
+                except OSError:
+                    pass
+
+        def run_cgi(self):
+            start = time.monotonic()
+            script, script_name, path_info, query = self.find_script()
+            if script is None:
+                self.send_error(404, 'No such CGI script')
+                return
+            env = self.cgi_environ(script_name, path_info, query)
+            if _is_chunked(env):
+                # The script gets the decoded body, up to EOF
+                del env['HTTP_TRANSFER_ENCODING']
+                env.pop('CONTENT_LENGTH', None)
+                length = -1
+            else:
+                try:
+                    length = max(0, int(env.get('CONTENT_LENGTH') or 0))
+                except ValueError:
+                    self.send_error(400, 'Bad Content-Length')
+                    return
+            if not slots.acquire(timeout=queue_timeout):
+                self.send_error(503, 'Too many running CGI scripts')
+                return
+            released = False
+            try:
+                queued = time.monotonic()
+                try:
+                    proc = subprocess.Popen(
+                        _script_command(script), stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE, cwd=os.path.dirname(script),
+                        env=env)
+                except OSError as err:
+                    # Not executable, or a bad #! line
+                    self.log_error('"%s" cannot run %s: %s',
+                                   self.requestline, script, err)
+                    self.send_error(500, 'Cannot run CGI script')
+                    return
+                spawned = time.monotonic()
+                exited = threading.Event()
+                copier = threading.Thread(target=self.copy_body,
+                                          args=(proc.stdin, length, exited),
+                                          daemon=True)
+                copier.start()
+                try:
+                    sent = self.relay_output(proc.stdout, (start, queued,
+                                                           spawned))
+                finally:
+                    proc.stdout.close()
+                    status = proc.wait()
+                    exited.set()
+                    slots.release()
+                    released = True
+                    if copier.is_alive():
+                        # The script is done with the body: stop waiting
+                        # for the rest of it, and for another request
+                        self.close_connection = True
+                        try:
+                            self.connection.shutdown(socket.SHUT_RD)
+                        except OSError:
+                            pass
+                    copier.join()
+            finally:
+                if not released:
+                    slots.release()
+            self.log_message('"%s" %s exit=%d queue=%.1fms spawn=%.1fms '
+                             'total=%.1fms out=%d', self.requestline,
+                             self.cgi_status, status,
+                             (queued - start) * 1e3, (spawned - queued) * 1e3,
+                             (time.monotonic() - start) * 1e3, sent)
+
+        def relay_output(self, stdout, times):
+            """Send the script's headers and stream its output."""
+            start, queued, spawned = times
+            headers = []
+            size = 0
+            while True:
+                line = stdout.readline(1 << 16)
+                size += len(line)
+                if not line or size > 1 << 16:
+                    self.cgi_status = 502
+                    self.send_error(502, 'Bad CGI response headers')
+                    return 0
+                line = line.rstrip(b'\r\n')
+                if not line:
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers.append((name.strip(), value.strip()))
+            status, message = 200, None
+            names = [name.lower() for name, value in headers]
+            if 'status' in names:
+                value = headers[names.index('status')][1]
+                code, _, message = value.partition(' ')
+                try:
+                    status = int(code)
+                except ValueError:
+                    status = 502
+            elif 'location' in names:
+                status = 302
+            self.cgi_status = status
+            self.send_response(status, message or None)
+            for name, value in headers:
+                if name.lower() != 'status':
+                    self.send_header(name, value)
+            first = time.monotonic()
+            self.send_header('Server-Timing',
+                             'queue;dur=%.3f, spawn;dur=%.3f, headers;dur=%.3f'
+                             % ((queued - start) * 1e3,
+                                (spawned - queued) * 1e3,
+                                (first - spawned) * 1e3))
+            self.end_headers()
+            sent = 0
+            while True:
+                data = stdout.read1(1 << 16)
+                if not data:
+                    break
+                if self.command != 'HEAD':
+                    self.wfile.write(data)
+                    sent += len(data)
+            return sent
+
+    # Seconds a client may stall while sending its request or reading
+    # the response
+    CGIRequestHandler.timeout = timeout
+    return CGIRequestHandler
+
+def serve(cgi_dir, address=('127.0.0.1', 8000), prefix='/cgi-bin',
+          max_children=16, queue_timeout=30.0, ready=None, timeout=60.0):
+    """Serve the scripts in cgi_dir over HTTP, each request in a process.
+
+    Requests for prefix/script run script from cgi_dir as a CGI process,
+    with anything after it in the path as PATH_INFO.  Request bodies,
+    after removing any chunked transfer coding, are streamed to the
+    script's standard input and its output is streamed back.  At most
+    max_children scripts run at once; other requests wait for up to
+    queue_timeout seconds before getting a 503 response.  Responses have
+    a Server-Timing header with the time spent waiting, starting the
+    process and until the script's headers; each request is logged
+    with its total time.  A client that sends nothing for timeout
+    seconds, while sending its request or reading the response, is
+    disconnected.  ready, if given, is called with the server once it is
+    listening.  Runs until interrupted or until the server's
+    shutdown() method is called.
+    """
+    import http.server
+    import threading
+    handler = _make_request_handler(cgi_dir, prefix.rstrip('/'),
+                                    threading.BoundedSemaphore(max_children),
+                                    queue_timeout, timeout)
+    with http.server.ThreadingHTTPServer(address, handler) as server:
+        if ready is not None:
+            ready(server)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+# "python -m cgi loadtest" runs a script as a real CGI process, many times
+# and concurrently, with a generated request, and reports the throughput
+# and latency percentiles.  No server or network is involved.
+
+_LOADTEST_WORKLOADS = ('get', 'urlencoded', 'multipart')
+
+def _loadtest_request(workload, fields=10, field_size=16, files=0,
+                      file_size=1024):
+    """Internal: return the CGI environ and body of a generated request."""
+    import urllib.parse
+    value = 'v' * field_size
+    pairs = [('field%d' % i, value) for i in range(fields)]
+    if workload == 'get':
+        return ({'REQUEST_METHOD': 'GET',
+                 'QUERY_STRING': urllib.parse.urlencode(pairs)}, b'')
+    if workload == 'urlencoded':
+        body = urllib.parse.urlencode(pairs).encode('ascii')
+        ctype = 'application/x-www-form-urlencoded'
+    elif workload == 'multipart':
+        boundary = '----loadtest-%s' % os.urandom(8).hex()
+        parts = [b'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+                 b'%s\r\n' % (boundary.encode(), name.encode(), value.encode())
+                 for name, value in pairs]
+        line = b'0123456789abcdef' * 4 + b'\r\n'
+        data = (line * (file_size // len(line) + 1))[:file_size]
+        for i in range(files):
+            parts.append(b'--%s\r\nContent-Disposition: form-data; '
+                         b'name="file%d"; filename="file%d.bin"\r\n'
+                         b'Content-Type: application/octet-stream\r\n\r\n'
+                         b'%s\r\n' % (boundary.encode(), i, i, data))
+        parts.append(b'--%s--\r\n' % boundary.encode())
+        body = b''.join(parts)
+        ctype = 'multipart/form-data; boundary=%s' % boundary
+    else:
+        raise ValueError('unknown workload: %r' % (workload,))
+    return ({'REQUEST_METHOD': 'POST', 'QUERY_STRING': '',
+             'CONTENT_TYPE': ctype, 'CONTENT_LENGTH': str(len(body))}, body)
+
+def _percentile(samples, pct):
+    """Internal: return the pct percentile of sorted samples (nearest rank)."""
+    import math
+    return samples[max(0, math.ceil(len(samples) * pct / 100) - 1)]
+
+def loadtest(script, workload='get', requests=100, concurrency=1, fields=10,
+             field_size=16, files=0, file_size=1024, timeout=60.0):
+    """Run a script as a CGI process many times and measure it.
+
+    The script is run requests times, concurrency of them at once, each
+    time with the same request generated for workload: 'get' (fields
+    in the query string), 'urlencoded' or 'multipart' (fields and files
+    in the body, which is written to the script's standard input).
+    Every field value is field_size bytes long and every file file_size
+    bytes.  A script that runs for more than timeout seconds is killed.
+    Returns a dictionary with the request count, the elapsed time, the
+    throughput, the 50th, 95th and 99th percentile, mean and largest
+    latency in milliseconds, the number of runs per exit status and the
+    bytes written by the script.
+    """
+    import collections
+    import concurrent.futures
+    import subprocess
+    import time
+    if requests < 1 or concurrency < 1:
+        raise ValueError('requests and concurrency must be positive')
+    path = os.path.realpath(script)
+    environ, body = _loadtest_request(workload, fields, field_size, files,
+                                      file_size)
+    env = {name: value for name, value in os.environ.items()
+           if not name.startswith('HTTP_')
+           and name not in ('CONTENT_TYPE', 'CONTENT_LENGTH')}
+    env.update({
+        'SERVER_SOFTWARE': 'cgi.py loadtest',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'GATEWAY_INTERFACE': 'CGI/1.1',
+        'SCRIPT_NAME': '/cgi-bin/' + os.path.basename(path),
+        'PATH_INFO': '',
+        'REMOTE_ADDR': '127.0.0.1',
+        'HTTP_HOST': 'localhost',
+    })
+    env.update(environ)
+    args = _script_command(path)
+    cwd = os.path.dirname(path)
+
+    def run_once():
+        start = time.perf_counter()
+        try:
+            proc = subprocess.run(args, input=body, capture_output=True,
+                                  cwd=cwd, env=env, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return time.perf_counter() - start, 'timeout', 0
+        return time.perf_counter() - start, proc.returncode, len(proc.stdout)
+
+    # A first run writes the .pyc files of the modules the script imports
+    run_once()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(lambda i: run_once(), range(requests)))
+        elapsed = time.perf_counter() - start
+    latencies = sorted(result[0] * 1e3 for result in results)
+    statuses = collections.Counter(result[1] for result in results)
+    return {'script': script, 'workload': workload,
+            'requests': requests, 'concurrency': concurrency,
+            'body_bytes': len(body), 'seconds': elapsed,
+            'requests_per_s': requests / elapsed,
+            'p50_ms': _percentile(latencies, 50),
+            'p95_ms': _percentile(latencies, 95),
+            'p99_ms': _percentile(latencies, 99),
+            'mean_ms': sum(latencies) / requests,
+            'max_ms': latencies[-1],
+            'exit_status': {str(status): count
+                            for status, count in sorted(statuses.items(),
+                                                        key=str)},
+            'output_bytes': sum(result[2] for result in results)}
+
+
+def _main(argv=None):
+    """Internal: the command line interface, "python -m cgi".
+
+    Without a known command, run test() as a CGI script would.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    commands = {
+        'serve-workers': (_serve_workers_arguments, _serve_workers_command),
+        'serve-fork': (_serve_fork_arguments, _serve_fork_command),
+        'serve': (_serve_arguments, _serve_command),
+        'loadtest': (_loadtest_arguments, _loadtest_command),
+        'replay': (_replay_arguments, _replay_command),
+    }
+    if not argv or argv[0] not in commands:
+        test()
+        return 0
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m cgi')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, (add_arguments, command) in commands.items():
+        add_arguments(subparsers.add_parser(name))
+    args = parser.parse_args(argv)
+    return commands[args.command][1](args)
+
+def _serve_workers_arguments(parser):
+    parser.description = ('Run the scripts in a cgi-bin directory in a pool '
+                          'of warm worker processes.')
+    parser.add_argument('--cgi-dir', default='cgi-bin',
+                        help='directory of the scripts (default: cgi-bin)')
+    parser.add_argument('--socket', required=True,
+                        help='path of the Unix domain socket to listen on')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of worker processes (default: 4)')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='replace a worker after this many requests')
+
+def _serve_workers_command(args):
+    def ready():
+        print('Serving %s on %s with %d workers'
+              % (args.cgi_dir, args.socket, args.workers), flush=True)
+    serve_workers(args.socket, args.cgi_dir, args.workers, args.max_requests,
+                  ready)
+    return 0
+
+def _serve_fork_arguments(parser):
+    parser.description = ('Fork a process per request to run the scripts in '
+                          'a cgi-bin directory, from a parent with modules '
+                          'preloaded.')
+    parser.add_argument('--cgi-dir', default='cgi-bin',
+                        help='directory of the scripts (default: cgi-bin)')
+    parser.add_argument('--socket', required=True,
+                        help='path of the Unix domain socket to listen on')
+    parser.add_argument('--preload', action='append', default=[],
+                        metavar='MODULE',
+                        help='module to import in the parent; may be repeated '
+                             'or comma separated')
+
+def _serve_fork_command(args):
+    preload = [name for value in args.preload for name in value.split(',')
+               if name]
+    def ready():
+        print('Serving %s on %s, preloaded %s'
+              % (args.cgi_dir, args.socket,
+                 ', '.join(['cgi', 'cgitb'] + preload)), flush=True)
+    serve_fork(args.socket, args.cgi_dir, preload, ready)
+    return 0
+
+def _serve_arguments(parser):
+    parser.description = ('Serve the scripts in a cgi-bin directory over '
+                          'HTTP, running each request as a CGI process.')
+    parser.add_argument('--cgi-dir', default='cgi-bin',
+                        help='directory of the scripts (default: cgi-bin)')
+    parser.add_argument('--bind', default='127.0.0.1',
+                        help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on (default: 8000)')
+    parser.add_argument('--prefix', default='/cgi-bin',
+                        help='URL path of the scripts (default: /cgi-bin)')
+    parser.add_argument('--max-children', type=int, default=16,
+                        help='most scripts running at once (default: 16)')
+    parser.add_argument('--queue-timeout', type=float, default=30.0,
+                        help='seconds a request waits for a free slot '
+                             '(default: 30)')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='seconds a client may stall (default: 60)')
+
+def _serve_command(args):
+    def ready(server):
+        host, port = server.server_address[:2]
+        print('Serving %s at http://%s:%d%s/' % (args.cgi_dir, host, port,
+                                                 args.prefix.rstrip('/')),
+              flush=True)
+    serve(args.cgi_dir, (args.bind, args.port), args.prefix,
+          args.max_children, args.queue_timeout, ready, args.timeout)
+    return 0
+
+def _loadtest_arguments(parser):
+    parser.description = ('Run CGI scripts as processes with a generated '
+                          'request and report throughput and latency.')
+    parser.add_argument('scripts', nargs='+', metavar='script',
+                        help='scripts to run, e.g. cgi-bin/*.py')
+    parser.add_argument('--workload', choices=_LOADTEST_WORKLOADS,
+                        default='get', help='request to send (default: get)')
+    parser.add_argument('-n', '--requests', type=int, default=100,
+                        help='runs per script (default: 100)')
+    parser.add_argument('-c', '--concurrency', type=int, default=1,
+                        help='runs at a time (default: 1)')
+    parser.add_argument('--fields', type=int, default=10,
+                        help='form fields in the request (default: 10)')
+    parser.add_argument('--field-size', type=int, default=16,
+                        help='bytes per field value (default: 16)')
+    parser.add_argument('--files', type=int, default=0,
+                        help='multipart file parts (default: 0)')
+    parser.add_argument('--file-size', type=int, default=1024,
+                        help='bytes per file part (default: 1024)')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='seconds before a run is killed (default: 60)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+
+def _loadtest_command(args):
+    import json
+    results = []
+    for script in args.scripts:
+        result = loadtest(script, args.workload, args.requests,
+                          args.concurrency, args.fields, args.field_size,
+                          args.files, args.file_size, args.timeout)
+        results.append(result)
+        if args.json:
+            continue
+        print('%s: %s, %d bytes, %d requests, concurrency %d' % (
+            script, args.workload, result['body_bytes'], args.requests,
+            args.concurrency))
+        print('  %.1f requests/s' % result['requests_per_s'])
+        print('  latency ms: p50 %.1f  p95 %.1f  p99 %.1f  mean %.1f  '
+              'max %.1f' % (result['p50_ms'], result['p95_ms'],
+                            result['p99_ms'], result['mean_ms'],
+                            result['max_ms']))
+        print('  exit status: %s' % ', '.join(
+            '%s x%d' % item for item in result['exit_status'].items()))
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    return 0
+
+def _replay_arguments(parser):
+    parser.description = ('Parse a request recorded with CGI_RECORD_DIR or '
+                          'enable_recording() again, optionally profiled.')
+    parser.add_argument('capture', help='capture file to replay')
+    parser.add_argument('--api', choices=('FieldStorage', 'parse'),
+                        default='FieldStorage',
+                        help='parser to run (default: FieldStorage)')
+    parser.add_argument('-n', '--repeat', type=int, default=1,
+                        help='parses to run (default: 1)')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the parses with cProfile and print '
+                             'the statistics')
+    parser.add_argument('--sort', default='cumulative',
+                        help='sort order of the statistics '
+                             '(default: cumulative)')
+    parser.add_argument('--limit', type=int, default=30,
+                        help='functions to print (default: 30)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the profile to FILE, for pstats or '
+                             'snakeviz')
+
+def _replay_command(args):
+    import statistics
+    environ, body, header = _read_capture(args.capture)
+    print('%s %s, %s, %d of %d body bytes' % (
+        environ.get('REQUEST_METHOD', 'GET'),
+        environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+        environ.get('CONTENT_TYPE', 'no content type'), len(body),
+        header['body_size']))
+    metrics = header.get('metrics') or {}
+    if metrics.get('total_time'):
+        print('recorded: parse %.2f ms, %d parts, process %.2f ms' % (
+            metrics['total_time'] * 1e3, metrics['parts'],
+            header['elapsed'] * 1e3))
+    profiler = None
+    if args.profile or args.output:
+        import cProfile
+        profiler = cProfile.Profile()
+    times = replay(args.capture, args.api, args.repeat, profiler)
+    print('replayed: %d parses, min %.2f ms, median %.2f ms, max %.2f ms' % (
+        len(times), min(times) * 1e3, statistics.median(times) * 1e3,
+        max(times) * 1e3))
+    if args.output:
+        profiler.dump_stats(args.output)
+    if args.profile:
+        import pstats
+        print()
+        pstats.Stats(profiler).sort_stats(args.sort).print_stats(args.limit)
+    return 0
+
+# Start profiling this request if asked to by the environment.  Not when
+# run as a script: the mainline imports cgi, which does it once.
+if __name__ != '__main__' and os.environ.get('CGI_PROFILE_DIR'):
+    try:
+        _rate = float(os.environ.get('CGI_PROFILE_RATE', 1))
+    except ValueError:
+        _rate = 1.0
+    enable_profiling(os.environ['CGI_PROFILE_DIR'], _rate)
+    del _rate
+
+# Record this request if asked to by the environment
+if __name__ != '__main__' and os.environ.get('CGI_RECORD_DIR'):
+    try:
+        _rate = float(os.environ.get('CGI_RECORD_RATE', 1))
+    except ValueError:
+        _rate = 1.0
+    try:
+        _max_body = int(os.environ['CGI_RECORD_MAX_BODY'])
+    except (KeyError, ValueError):
+        _max_body = None
+    enable_recording(os.environ['CGI_RECORD_DIR'], _rate, _max_body)
+    del _rate, _max_body
 
 # Invoke mainline
 # ===============
 
-# Call test() when this file is run as a script (not imported as a module)
+# Call test() when this file is run as a script (not imported as a module),
+# or run a command.  The commands use the module as scripts import it.
 if __name__ == '__main__':
-    test()
+    import cgi
+    sys.exit(cgi._main())
@@ -1,13 +1,27 @@
 import cgi
+import contextlib
+import email.message
 import os
+import shutil
+import socket
+import subprocess
 import sys
 import tempfile
+import time
+import tracemalloc
 import unittest
+import unittest.mock
+import urllib.parse
 from collections import namedtuple
 from io import StringIO, BytesIO
 
 import pytest
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 class HackedSysModule:
     # The regression test will have real values in sys.argv, which
@@ -114,6 +128,21 @@ def gen_result(data, environ):
 
     return result
 
+@contextlib.contextmanager
+def _upload_body(size, line):
+    """Yield (fp, environ) for a multipart upload of about size bytes."""
+    with tempfile.TemporaryFile() as fp:
+        fp.write(b'--B\r\nContent-Disposition: form-data; name="upload"; '
+                 b'filename="big.bin"\r\n\r\n')
+        block = line * 1024
+        for _ in range(size // len(block)):
+            fp.write(block)
+        fp.write(b'\r\n--B--\r\n')
+        env = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(fp.tell()),
+               'CONTENT_TYPE': 'multipart/form-data; boundary=B'}
+        fp.seek(0)
+        yield fp, env
+
 class CgiTests(unittest.TestCase):
 
     def test_parse_multipart(self):
@@ -390,6 +419,1336 @@ Test
         with self.assertRaisesRegex(ValueError, 'I/O operation on closed file'):
             fs.file.read()
 
+    def test_fieldstorage_class_old_signature(self):
+        # A FieldStorageClass written against the original constructor
+        # signature only gets the options that are actually used
+        class Part(cgi.FieldStorage):
+            def __init__(self, fp=None, headers=None, outerboundary=b'',
+                         environ=os.environ, keep_blank_values=0,
+                         strict_parsing=0, limit=None, encoding='utf-8',
+                         errors='replace', max_num_fields=None,
+                         separator='&'):
+                super().__init__(fp, headers, outerboundary, environ,
+                                 keep_blank_values, strict_parsing, limit,
+                                 encoding, errors, max_num_fields, separator)
+
+        class Form(cgi.FieldStorage):
+            FieldStorageClass = Part
+
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY_W3),
+            'CONTENT_LENGTH': str(len(POSTDATA_W3))}
+        fs = Form(BytesIO(POSTDATA_W3.encode('latin-1')), environ=env,
+                  encoding='latin-1')
+        self.assertIsInstance(fs['submit-name'], Part)
+        self.assertEqual(fs.getvalue('submit-name'), 'Larry')
+        self.assertEqual(len(fs['files'].value), 2)
+
+    def test_fieldstorage_digests(self):
+        import hashlib
+        import zlib
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY),
+            'CONTENT_LENGTH': '558'}
+        fp = BytesIO(POSTDATA.encode('latin-1'))
+        fs = cgi.FieldStorage(fp, environ=env, encoding="latin-1",
+                              digests=[hashlib.sha256, zlib.crc32])
+        self.assertIsNone(fs.digests)
+        for part in fs.list:
+            raw = part.value
+            if isinstance(raw, str):
+                raw = raw.encode('latin-1')
+            self.assertEqual(part.digests, {
+                'sha256': hashlib.sha256(raw).hexdigest(),
+                'crc32': '%08x' % zlib.crc32(raw)})
+
+    def test_fieldstorage_content_md5(self):
+        import base64
+        import hashlib
+        def post(md5):
+            data = ('--X\r\n'
+                    'Content-Disposition: form-data; name="f"; filename="a"\r\n'
+                    'Content-MD5: %s\r\n'
+                    '\r\n'
+                    'hello\r\n'
+                    '--X--\r\n' % md5)
+            env = {'REQUEST_METHOD': 'POST',
+                   'CONTENT_TYPE': 'multipart/form-data; boundary=X',
+                   'CONTENT_LENGTH': str(len(data))}
+            return cgi.FieldStorage(BytesIO(data.encode()), environ=env,
+                                    verify_content_md5=True)
+        good = base64.b64encode(hashlib.md5(b'hello').digest()).decode()
+        fs = post(good)
+        self.assertEqual(fs['f'].value, b'hello')
+        self.assertIsNone(fs['f'].digests)
+        bad = base64.b64encode(hashlib.md5(b'world').digest()).decode()
+        with self.assertRaisesRegex(ValueError, 'Content-MD5 mismatch'):
+            post(bad)
+
+    def test_fieldstorage_pipelined(self):
+        data = POSTDATA.encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY),
+            'CONTENT_LENGTH': str(len(data))}
+        expected = cgi.FieldStorage(BytesIO(data), environ=env,
+                                    encoding="latin-1")
+        for depth in (1, 2, 16):
+            fp = BytesIO(data + b'trailing')
+            fs = cgi.FieldStorage(fp, environ=env, encoding="latin-1",
+                                  pipeline_depth=depth)
+            self.assertIs(fs.fp, fp)
+            self.assertEqual([(p.name, p.filename, p.value) for p in fs.list],
+                             [(p.name, p.filename, p.value)
+                              for p in expected.list])
+            # Nothing past CONTENT_LENGTH is consumed.
+            self.assertEqual(fp.read(), b'trailing')
+
+    def test_fieldstorage_pipelined_error(self):
+        # A parse error while the client is still sending the body is
+        # raised at once, without waiting for the rest of the body.
+        import threading
+        data = (b'--X\r\nContent-Disposition: form-data; name="a"\r\n\r\n1\r\n'
+                b'--X\r\nContent-Disposition: form-data; name="b"\r\n\r\n2\r\n'
+                b'--X\r\n')
+        env = {'REQUEST_METHOD': 'POST',
+               'CONTENT_TYPE': 'multipart/form-data; boundary=X',
+               'CONTENT_LENGTH': str(len(data) + 100000)}
+        r, w = os.pipe()
+        fp = open(r, 'rb')
+        errors = []
+
+        def parse():
+            try:
+                cgi.FieldStorage(fp, environ=env, pipeline_depth=2,
+                                 max_num_fields=1)
+            except ValueError as exc:
+                errors.append(exc)
+
+        with fp, open(w, 'wb') as client:
+            client.write(data)
+            client.flush()
+            thread = threading.Thread(target=parse, daemon=True)
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            # The client going away ends the read still in progress
+            client.close()
+        self.assertEqual(str(errors[0]), 'Max number of fields exceeded')
+
+    def test_pipelined_reader_lines(self):
+        data = b'a\r\nbb\n' + b'x' * 100000 + b'\nend'
+        class Chunks(cgi._InputLayer):
+            def __init__(self, data):
+                super().__init__()
+                self.chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+            def _fill(self):
+                return self.chunks.pop(0) if self.chunks else b''
+        for reader in (Chunks(data),
+                       cgi._PipelinedReader(BytesIO(data), len(data), 2)):
+            ref = BytesIO(data)
+            for size in (-1, 1, 5, 1 << 16, 3):
+                self.assertEqual(reader.readline(size), ref.readline(size))
+            self.assertEqual(reader.read(10), ref.read(10))
+            self.assertEqual(reader.read(), ref.read())
+            self.assertEqual(reader.read(), b'')
+            reader.close()
+
+    def test_fieldstorage_processors(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY_W3),
+            'CONTENT_LENGTH': str(len(POSTDATA_W3))}
+        threads = set()
+        def size(part):
+            threads.add(threading.get_ident())
+            return len(part.file.read())
+        def name(part):
+            return part.filename
+        fs = cgi.FieldStorage(BytesIO(POSTDATA_W3.encode('latin-1')),
+                              environ=env, processors=[size, name])
+        self.assertNotIn(threading.get_ident(), threads)
+        # Plain fields are not files to process
+        self.assertIsNone(fs.list[0].results)
+        self.assertIsNone(fs.list[0].futures)
+        self.assertIsNone(fs.list[1].results)
+        self.assertEqual([f.results for f in fs.list[1].value],
+                         [[29, 'file1.txt'], [27, 'file2.gif']])
+
+        def fail(part):
+            raise RuntimeError(part.filename)
+        with ThreadPoolExecutor(1) as executor:
+            fs = cgi.FieldStorage(BytesIO(POSTDATA_W3.encode('latin-1')),
+                                  environ=env, processors=[fail],
+                                  executor=executor, wait_processors=False)
+            part = fs['files'].value[0]
+            self.assertIsNone(part.results)
+            self.assertEqual(len(part.futures), 1)
+            with self.assertRaisesRegex(RuntimeError, 'file1.txt'):
+                fs.wait_processors()
+
+    def test_chunked_body(self):
+        def chunked(data, size=7):
+            out = b''.join(b'%x;ext=1\r\n%s\r\n' % (len(data[i:i + size]),
+                                                      data[i:i + size])
+                           for i in range(0, len(data), size))
+            return out + b'0\r\nX-Trailer: yes\r\n\r\n'
+        body = POSTDATA_W3.encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY_W3),
+            'HTTP_TRANSFER_ENCODING': 'chunked'}
+        fp = BytesIO(chunked(body) + b'after')
+        fs = cgi.FieldStorage(fp, environ=env)
+        self.assertEqual(fs['submit-name'].value, 'Larry')
+        self.assertEqual(fs['files'].value[1].value,
+                         b'...contents of file2.gif...')
+        self.assertEqual(fp.read(), b'after')
+        fp = BytesIO(chunked(body) + b'after')
+        self.assertEqual(cgi.parse(fp, dict(env))['submit-name'], ['Larry'])
+        self.assertEqual(fp.read(), b'after')
+
+        env = {'REQUEST_METHOD': 'POST',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'HTTP_TRANSFER_ENCODING': 'chunked',
+               'QUERY_STRING': 'c=3'}
+        data = chunked(b'a=1&b=2', 3)
+        self.assertEqual(cgi.parse(BytesIO(data), dict(env)),
+                         {'a': ['1'], 'b': ['2'], 'c': ['3']})
+        fs = cgi.FieldStorage(BytesIO(data), environ=env)
+        self.assertEqual(fs.getvalue('b'), '2')
+
+        for bad, msg in [(b'zz\r\n', 'Invalid chunk size'),
+                         (b'1_0\r\n' + b'x' * 16, 'Invalid chunk size'),
+                         (b'5\r\nab', 'Incomplete'),
+                         (b'2\r\nabc\r\n', 'Missing CRLF'),
+                         (b'1' * 2000 + b'\r\n', 'line too long'),
+                         (b'0\r\n' + b'X: y\r\n' * 2000, 'trailers too long')]:
+            with self.assertRaisesRegex(ValueError, msg):
+                cgi.parse(BytesIO(bad), dict(env))
+
+    def test_content_encoding(self):
+        import gzip
+        import zlib
+        body = POSTDATA_W3.encode('latin-1')
+        raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        for coding, data in [('gzip', gzip.compress(body)),
+                             ('deflate', zlib.compress(body)),
+                             ('deflate', raw.compress(body) + raw.flush())]:
+            env = {
+                'REQUEST_METHOD': 'POST',
+                'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY_W3),
+                'CONTENT_LENGTH': str(len(data)),
+                'HTTP_CONTENT_ENCODING': coding}
+            fp = BytesIO(data + b'after')
+            fs = cgi.FieldStorage(fp, environ=env)
+            self.assertEqual(fs['submit-name'].value, 'Larry')
+            self.assertEqual(fs['files'].value[0].value,
+                             b'... contents of file1.txt ...')
+            self.assertEqual(fp.read(), b'after')
+            fp = BytesIO(data + b'after')
+            self.assertEqual(cgi.parse(fp, dict(env))['submit-name'],
+                             ['Larry'])
+            self.assertEqual(fp.read(), b'after')
+
+        data = gzip.compress(b'a=1&b=2')
+        env = {'REQUEST_METHOD': 'POST',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'CONTENT_LENGTH': str(len(data)),
+               'HTTP_CONTENT_ENCODING': 'gzip',
+               'QUERY_STRING': ''}
+        self.assertEqual(cgi.parse(BytesIO(data), dict(env)),
+                         {'a': ['1'], 'b': ['2']})
+        fs = cgi.FieldStorage(BytesIO(data), environ=env)
+        self.assertEqual(fs.getvalue('a'), '1')
+        with self.assertRaisesRegex(ValueError, 'decompressed length'):
+            cgi.parse(BytesIO(data), dict(env), max_decompressed_size=5)
+        with self.assertRaisesRegex(ValueError, 'Incomplete gzip'):
+            cgi.parse(BytesIO(data[:-10]), dict(env, CONTENT_LENGTH='20'))
+        with self.assertRaisesRegex(ValueError, 'Invalid gzip'):
+            cgi.parse(BytesIO(b'x' * 20), dict(env, CONTENT_LENGTH='20'))
+
+        data = gzip.compress(b'a=1&') + gzip.compress(b'b=2')
+        env['CONTENT_LENGTH'] = str(len(data))
+        self.assertEqual(cgi.parse(BytesIO(data), dict(env)),
+                         {'a': ['1'], 'b': ['2']})
+        data = zlib.compress(b'a=1') + b'junk'
+        with self.assertRaisesRegex(ValueError, 'Trailing data'):
+            cgi.parse(BytesIO(data), dict(env, HTTP_CONTENT_ENCODING='deflate',
+                                          CONTENT_LENGTH=str(len(data))))
+        for coding in ('br', 'gzip, br'):
+            with self.assertRaisesRegex(ValueError, 'Unsupported'):
+                cgi.FieldStorage(BytesIO(data), environ=dict(
+                    env, HTTP_CONTENT_ENCODING=coding))
+
+    def test_content_encoding_bomb(self):
+        import gzip
+        data = gzip.compress(b'a=' + b'0' * (4 << 20))
+        env = {'REQUEST_METHOD': 'POST',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'CONTENT_LENGTH': str(len(data)),
+               'HTTP_CONTENT_ENCODING': 'gzip',
+               'QUERY_STRING': ''}
+        with self.assertRaisesRegex(ValueError, 'compression ratio'):
+            cgi.FieldStorage(BytesIO(data), environ=env)
+        fs = cgi.FieldStorage(BytesIO(data), environ=env,
+                              max_compression_ratio=0)
+        self.assertEqual(len(fs.getvalue('a')), 4 << 20)
+
+    def test_parse_records(self):
+        data = b'{"a": 1}\n\n{"b": [2, 3]}\n"\xe2\x98\x83"' + b'extra'
+        env = {'CONTENT_TYPE': 'application/x-ndjson',
+               'CONTENT_LENGTH': str(len(data) - 5)}
+        fp = BytesIO(data)
+        self.assertEqual(list(cgi.parse_records(fp, env)),
+                         [{'a': 1}, {'b': [2, 3]}, '\u2603'])
+        self.assertEqual(fp.read(), b'extra')
+
+        data = 'id,name\r\n1,"multi\r\nline"\r\n2,\xe9\r\n'.encode('latin-1')
+        env = {'CONTENT_TYPE': 'text/csv; charset=latin-1',
+               'CONTENT_LENGTH': str(len(data))}
+        self.assertEqual(list(cgi.parse_records(BytesIO(data), env)),
+                         [['id', 'name'], ['1', 'multi\r\nline'],
+                          ['2', '\xe9']])
+
+        env = {'CONTENT_TYPE': 'application/x-ndjson'}
+        with self.assertRaisesRegex(ValueError, 'record size'):
+            list(cgi.parse_records(BytesIO(b'1\n' + b'2' * 100), env,
+                                   max_record_size=50))
+        with self.assertRaisesRegex(ValueError, 'Unsupported'):
+            next(cgi.parse_records(BytesIO(b''), {'CONTENT_TYPE': 'text/plain'}))
+
+    def test_parse_json(self):
+        data = b'{"a": [1, 2]}'
+        env = {'CONTENT_TYPE': 'application/json',
+               'CONTENT_LENGTH': str(len(data))}
+        self.assertEqual(cgi.parse_json(BytesIO(data + b'{'), env),
+                         {'a': [1, 2]})
+        with self.assertRaisesRegex(ValueError, 'Maximum JSON size'):
+            cgi.parse_json(BytesIO(data), env, max_size=5)
+        env['CONTENT_TYPE'] = 'application/vnd.api+json; charset=utf-8'
+        self.assertEqual(cgi.parse_json(BytesIO(data), env), {'a': [1, 2]})
+        for ctype in ('application/x-www-form-urlencoded', 'text/plain', ''):
+            env['CONTENT_TYPE'] = ctype
+            with self.assertRaisesRegex(ValueError, 'Unsupported content'):
+                cgi.parse_json(BytesIO(data), env)
+
+    def test_read_timeout(self):
+        data = POSTDATA.encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY),
+            'CONTENT_LENGTH': str(len(data))}
+        r, w = os.pipe()
+        self.addCleanup(os.close, w)
+        with open(r, 'rb') as fp:
+            os.write(w, data[:100])
+            with self.assertRaisesRegex(cgi.ReadTimeout, 'No request data'):
+                cgi.FieldStorage(fp, environ=env, read_timeout=0.05)
+        r, w = os.pipe()
+        with open(r, 'rb') as fp:
+            os.write(w, data[:100])
+            with self.assertRaisesRegex(cgi.ReadTimeout, 'within 0.05'):
+                cgi.FieldStorage(fp, environ=env, read_timeout=10,
+                                 body_timeout=0.05)
+            os.write(w, data[100:])
+            os.close(w)
+        r, w = os.pipe()
+        with open(r, 'rb') as fp:
+            os.write(w, data + b'more')
+            fs = cgi.FieldStorage(fp, environ=env, read_timeout=1,
+                                  body_timeout=5, pipeline_depth=2)
+            self.assertEqual(fs['file'].value, b'Testing 123.\n')
+            os.close(w)
+            self.assertEqual(fp.read(), b'more')
+        # Without a file descriptor, a total deadline is still honored.
+        with self.assertRaises(cgi.ReadTimeout):
+            cgi.FieldStorage(BytesIO(data), environ=env, body_timeout=0)
+
+    def test_fieldstorage_progress(self):
+        import json
+        data = POSTDATA.encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY),
+            'CONTENT_LENGTH': str(len(data))}
+        calls = []
+        fs = cgi.FieldStorage(BytesIO(data), environ=env,
+                              progress=lambda *args: calls.append(args),
+                              progress_bytes=100, progress_interval=None)
+        self.assertEqual(calls[-1], (None, None, len(data), len(data), True))
+        counts = [c[2] for c in calls]
+        self.assertTrue(all(b - a >= 100 for a, b in zip(counts, counts[1:-1])))
+        self.assertEqual(fs.bytes_read, len(data))
+        calls = []
+        cgi.FieldStorage(BytesIO(data), environ=env,
+                         progress=lambda *args: calls.append(args),
+                         progress_bytes=1)
+        self.assertIn(('file', 'test.txt', False),
+                      [(c[0], c[1], c[4]) for c in calls])
+        counts = [c[2] for c in calls]
+        self.assertEqual(counts, sorted(counts))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            sink = cgi.ProgressFile(tmp, environ={'UNIQUE_ID': '../a/b'})
+            cgi.FieldStorage(BytesIO(data), environ=env, progress=sink)
+            self.assertEqual(os.listdir(tmp), ['_a_b.json'])
+            with open(sink.path) as f:
+                state = json.load(f)
+            self.assertEqual(state['bytes_read'], len(data))
+            self.assertEqual(state['content_length'], len(data))
+            self.assertTrue(state['done'])
+
+    def test_fieldstorage_metrics(self):
+        data = POSTDATA_W3.replace('...contents of file2.gif...',
+                                   'x' * 5000).encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY_W3),
+            'CONTENT_LENGTH': str(len(data))}
+        with cgi.FieldStorage(BytesIO(data), environ=env, metrics=True) as fs:
+            m = fs.metrics
+            self.assertIs(fs['files'].metrics, m)
+        self.assertEqual(m.bytes_read, len(data))
+        # submit-name, files and the two files inside files
+        self.assertEqual(m.parts, 4)
+        self.assertEqual(m.files_created, 1)
+        self.assertEqual(m.bytes_to_disk, 5000)
+        self.assertEqual(m.bytes_to_memory,
+                         len('Larry') + len('... contents of file1.txt ...'))
+        for name in ('header_time', 'scan_time', 'write_time', 'total_time'):
+            self.assertGreaterEqual(getattr(m, name), 0)
+        self.assertGreaterEqual(m.total_time, m.header_time + m.scan_time)
+        line = m.log_line()
+        self.assertIn('parts=4 files_created=1', line)
+        self.assertNotIn('\n', line)
+
+        metrics = cgi.ParseMetrics()
+        cgi.FieldStorage(environ={'REQUEST_METHOD': 'GET',
+                                  'QUERY_STRING': 'a=1&b=2'}, metrics=metrics)
+        self.assertEqual(metrics.bytes_read, 7)
+        self.assertIsNone(cgi.FieldStorage(environ={}).metrics)
+
+    def test_fieldstorage_metrics_bytes(self):
+        # Only the body counts, not QUERY_STRING
+        env = {'REQUEST_METHOD': 'POST',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'CONTENT_LENGTH': '7',
+               'QUERY_STRING': 'first=1&second=2&c=345'}
+        fs = cgi.FieldStorage(BytesIO(b'a=1&b=2'), environ=env, metrics=True)
+        self.assertEqual(len(fs.list), 5)
+        self.assertEqual(fs.metrics.bytes_read, 7)
+        # Bytes, not characters
+        data = ('--%s\r\nContent-Disposition: form-data; name="a"\r\n\r\n'
+                '%s\r\n--%s--\r\n' % (BOUNDARY_W3, '\xe9' * 10, BOUNDARY_W3)
+                ).encode('utf-8')
+        env = {'REQUEST_METHOD': 'POST',
+               'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % BOUNDARY_W3,
+               'CONTENT_LENGTH': str(len(data))}
+        fs = cgi.FieldStorage(BytesIO(data), environ=env, metrics=True)
+        self.assertEqual(fs.getvalue('a'), '\xe9' * 10)
+        self.assertEqual(fs.metrics.bytes_to_memory, 20)
+        self.assertEqual(fs.metrics.bytes_read, len(data))
+
+    def test_enable_profiling(self):
+        import pstats
+        self.assertIsNone(cgi.enable_profiling('/nonexistent', 0))
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, PYTHONPATH=root, CGI_PROFILE_DIR=tmp,
+                       UNIQUE_ID='abc', SCRIPT_NAME='/cgi-bin/form.py',
+                       REQUEST_METHOD='GET', QUERY_STRING='a=1')
+            script = os.path.join(root, 'cgi-bin', 'form.py')
+            out = subprocess.run([sys.executable, script], env=env,
+                                 capture_output=True, check=True)
+            self.assertIn(b'a: 1', out.stdout)
+            self.assertEqual(os.listdir(tmp), ['abc-cgi-bin.form.py.prof'])
+            stats = pstats.Stats(os.path.join(tmp, os.listdir(tmp)[0]))
+            self.assertTrue(any(func[2] == 'read_urlencoded'
+                                for func in stats.stats))
+            env['CGI_PROFILE_RATE'] = '0'
+            env['UNIQUE_ID'] = 'def'
+            subprocess.run([sys.executable, script], env=env, check=True,
+                           capture_output=True)
+            self.assertEqual(len(os.listdir(tmp)), 1)
+            # Run under another profiler, the request is still served
+            env['CGI_PROFILE_RATE'] = '1'
+            env['UNIQUE_ID'] = 'ghi'
+            out = subprocess.run([sys.executable, '-m', 'cProfile',
+                                  '-o', os.devnull, script], env=env,
+                                 capture_output=True, check=True)
+            self.assertIn(b'a: 1', out.stdout)
+            # A second call keeps the profiler of the first, so that the
+            # profile is not overwritten with an empty one at exit
+            env['UNIQUE_ID'] = 'jkl'
+            code = ('import cgi\n'
+                    'assert cgi.enable_profiling(%r) is cgi._profiler\n'
+                    'def request_work(): return sum(range(100))\n'
+                    'request_work()\n' % tmp)
+            subprocess.run([sys.executable, '-c', code], env=env, check=True)
+            stats = pstats.Stats(os.path.join(tmp, 'jkl-cgi-bin.form.py.prof'))
+            self.assertTrue(any(func[2] == 'request_work'
+                                for func in stats.stats))
+
+    def test_main_hooks(self):
+        # python -m cgi runs the profiling and recording hooks once
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        data = b'a=1&b=2'
+        with tempfile.TemporaryDirectory() as tmp:
+            # Not os.environ, which test() prints
+            env = dict(PYTHONPATH=root, CGI_PROFILE_DIR=tmp,
+                       CGI_RECORD_DIR=tmp, UNIQUE_ID='abc',
+                       REQUEST_METHOD='POST', CONTENT_LENGTH=str(len(data)),
+                       CONTENT_TYPE='application/x-www-form-urlencoded')
+            out = subprocess.run([sys.executable, '-m', 'cgi'], env=env,
+                                 input=data, capture_output=True, check=True)
+            self.assertIn(b'MiniFieldStorage(&#x27;b&#x27;, &#x27;2&#x27;)',
+                          out.stdout)
+            self.assertEqual(sorted(os.listdir(tmp)),
+                             ['abc-.cgicapture', 'abc-.prof'])
+            environ, body, header = cgi._read_capture(
+                os.path.join(tmp, 'abc-.cgicapture'))
+            self.assertEqual(body, data)
+            self.assertEqual(header['metrics']['bytes_read'], len(data))
+
+    def test_record_replay(self):
+        import cProfile
+        self.assertIsNone(cgi.enable_recording('/nonexistent', 0))
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        data = POSTDATA_W3.encode('latin-1')
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, PYTHONPATH=root, CGI_RECORD_DIR=tmp,
+                       UNIQUE_ID='abc', SCRIPT_NAME='/cgi-bin/form.py',
+                       REQUEST_METHOD='POST', QUERY_STRING='q=1',
+                       CONTENT_TYPE='multipart/form-data; boundary={}'
+                                    .format(BOUNDARY_W3),
+                       CONTENT_LENGTH=str(len(data)),
+                       HTTP_COOKIE='session=secret')
+            script = os.path.join(root, 'cgi-bin', 'form.py')
+            out = subprocess.run([sys.executable, script], env=env,
+                                 input=data, capture_output=True, check=True)
+            self.assertIn(b'submit-name: Larry', out.stdout)
+            filename = os.path.join(tmp, 'abc-cgi-bin.form.py.cgicapture')
+            environ, body, header = cgi._read_capture(filename)
+            self.assertEqual(body, data)
+            self.assertEqual(environ['QUERY_STRING'], 'q=1')
+            self.assertNotIn('HTTP_COOKIE', environ)
+            self.assertFalse(header['truncated'])
+            self.assertEqual(header['metrics']['bytes_read'], len(data))
+            self.assertEqual(header['metrics']['parts'], 4)
+
+            profiler = cProfile.Profile()
+            times = cgi.replay(filename, repeat=3, profiler=profiler)
+            self.assertEqual(len(times), 3)
+            profiler.create_stats()
+            self.assertTrue(any(func[2] == 'read_multi'
+                                for func in profiler.stats))
+            self.assertRaises(ValueError, cgi.replay, filename, 'json')
+            self.assertEqual(len(cgi.replay(filename, 'parse', 2)), 2)
+            with contextlib.redirect_stdout(StringIO()) as out:
+                self.assertEqual(cgi._main(['replay', filename, '--api',
+                                            'parse']), 0)
+            self.assertIn('multipart/form-data', out.getvalue())
+
+            env.update(UNIQUE_ID='def', CGI_RECORD_MAX_BODY='100')
+            subprocess.run([sys.executable, script], env=env, input=data,
+                           capture_output=True, check=True)
+            environ, body, header = cgi._read_capture(
+                os.path.join(tmp, 'def-cgi-bin.form.py.cgicapture'))
+            self.assertEqual(body, data[:100])
+            self.assertTrue(header['truncated'])
+
+            filename = os.path.join(tmp, 'urlencoded.cgicapture')
+            cgi._write_capture(filename, {
+                'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': '7',
+                'CONTENT_TYPE': 'application/x-www-form-urlencoded'},
+                               b'a=1&b=2', {'body_size': 7})
+            self.assertEqual(len(cgi.replay(filename, 'parse', 2)), 2)
+
+    def test_request(self):
+        data = POSTDATA_W3.encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY_W3),
+            'CONTENT_LENGTH': str(len(data)),
+            'QUERY_STRING': 'a=1&a=2&b=',
+            'HTTP_COOKIE': 'session=abc; theme="dark"',
+            'HTTP_X_REQUEST_ID': 'r1',
+            'HTTP_USER_AGENT': 'test'}
+        fp = BytesIO(data)
+        with cgi.Request(env, fp) as req:
+            self.assertEqual(req.query, {'a': ['1', '2']})
+            self.assertEqual(req.cookies, {'session': 'abc', 'theme': 'dark'})
+            self.assertEqual(req.headers['x-request-id'], 'r1')
+            self.assertEqual(req.headers['Content-Type'], env['CONTENT_TYPE'])
+            self.assertIn('User-Agent', req.headers)
+            self.assertNotIn('Cookie2', req.headers)
+            self.assertEqual(sorted(req.headers), ['Content-Length',
+                             'Content-Type', 'Cookie', 'User-Agent',
+                             'X-Request-Id'])
+            self.assertEqual(fp.tell(), 0)
+        # The unread body is discarded
+        self.assertEqual(fp.tell(), len(data))
+
+        with cgi.Request(env, BytesIO(data)) as req:
+            self.assertIs(req.form, req.form)
+            self.assertEqual(req.form.getvalue('submit-name'), 'Larry')
+            files = req.files
+            self.assertEqual([f.filename for f in files['files']],
+                             ['file1.txt', 'file2.gif'])
+            self.assertIs(req.files, files)
+        self.assertTrue(files['files'][0].file.closed)
+
+        req = cgi.Request({'REQUEST_METHOD': 'GET', 'QUERY_STRING': 'x=1'},
+                          BytesIO())
+        self.assertEqual(req.form.getvalue('x'), '1')
+        self.assertEqual(req.files, {})
+        self.assertEqual(req.cookies, {})
+        req.close()
+
+    def test_fieldstorage_from_wsgi(self):
+        import wsgiref.util
+        data = POSTDATA.encode('latin-1')
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY),
+            'CONTENT_LENGTH': str(len(data)),
+            'QUERY_STRING': 'q=1',
+            'wsgi.input': BytesIO(data + b'unterminated stream')}
+        wsgiref.util.setup_testing_defaults(environ)
+        with unittest.mock.patch.object(cgi, 'sys') as mock_sys, \
+                unittest.mock.patch.dict(os.environ, QUERY_STRING='bad=1'):
+            fs = cgi.FieldStorage.from_wsgi(environ)
+        self.assertEqual(mock_sys.mock_calls, [])
+        self.assertEqual(fs.getvalue('id'), '1234')
+        self.assertEqual(fs.getvalue('q'), '1')
+        self.assertNotIn('bad', fs)
+        self.assertEqual(environ['wsgi.input'].tell(), len(data))
+        self.assertIs(cgi.FieldStorage.from_wsgi(environ), fs)
+        self.assertIs(environ['cgi.form'], fs)
+        fs.close()
+
+        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE':
+                   'application/x-www-form-urlencoded',
+                   'wsgi.input': BytesIO(b'a=1')}
+        self.assertEqual(list(cgi.FieldStorage.from_wsgi(environ)), [])
+        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE':
+                   'application/x-www-form-urlencoded',
+                   'HTTP_TRANSFER_ENCODING': 'chunked',
+                   'wsgi.input_terminated': True,
+                   'wsgi.input': BytesIO(b'a=1')}
+        self.assertEqual(cgi.FieldStorage.from_wsgi(environ).getvalue('a'),
+                         '1')
+        self.assertEqual(environ['HTTP_TRANSFER_ENCODING'], 'chunked')
+
+    @unittest.skipUnless(hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX'),
+                         'requires fork and Unix domain sockets')
+    def test_serve_workers(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as tmp:
+            address = os.path.join(tmp, 'workers.sock')
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'cgi', 'serve-workers', '--socket',
+                 address, '--cgi-dir', os.path.join(root, 'cgi-bin'),
+                 '--workers', '1', '--max-requests', '2'],
+                cwd=root, stdout=subprocess.PIPE)
+            try:
+                self.assertIn(b'Serving', server.stdout.readline())
+                body = b'a=1&b=2'
+                env = {'REQUEST_METHOD': 'POST', 'QUERY_STRING': 'q=3',
+                       'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                       'CONTENT_LENGTH': str(len(body))}
+                for _ in range(3):
+                    status, out, err = cgi._call_worker(address, 'form.py',
+                                                        env, body)
+                    self.assertEqual(status, 0)
+                    self.assertEqual(out, b'Content-Type: text/plain\n\n'
+                                          b'a: 1\nb: 2\nq: 3\n')
+                for script in ('crash_before_output.py',
+                               'crash_during_headers.py',
+                               'crash_after_output.py'):
+                    status, out, err = cgi._call_worker(address, script, env)
+                    self.assertEqual(status, 1)
+                    self.assertIn(b'ValueError', out)
+                status, out, err = cgi._call_worker(address, '../cgi.py', env)
+                self.assertEqual(status, 127)
+                self.assertIn(b'No such script', err)
+            finally:
+                server.terminate()
+                server.wait(10)
+                server.stdout.close()
+            self.assertFalse(os.path.exists(address))
+
+    @unittest.skipUnless(hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX'),
+                         'requires fork and Unix domain sockets')
+    def test_serve_fork(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as tmp:
+            address = os.path.join(tmp, 'fork.sock')
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'cgi', 'serve-fork', '--socket',
+                 address, '--cgi-dir', os.path.join(root, 'cgi-bin'),
+                 '--preload', 'json'],
+                cwd=root, stdout=subprocess.PIPE)
+
+            def run(script, body=b''):
+                r, w = os.pipe()
+                os.write(w, body)
+                os.close(w)
+                env = {'REQUEST_METHOD': 'POST', 'QUERY_STRING': 'q=3',
+                       'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                       'CONTENT_LENGTH': str(len(body))}
+                with tempfile.TemporaryFile() as out, \
+                        tempfile.TemporaryFile() as err:
+                    try:
+                        status = cgi._call_fork_server(
+                            address, script, env, r, out.fileno(),
+                            err.fileno())
+                    finally:
+                        os.close(r)
+                    out.seek(0)
+                    err.seek(0)
+                    return status, out.read(), err.read()
+
+            try:
+                self.assertIn(b'cgitb, json', server.stdout.readline())
+                self.assertEqual(run('form.py', b'a=1&b=2'),
+                                 (0, b'Content-Type: text/plain\n\n'
+                                     b'a: 1\nb: 2\nq: 3\n', b''))
+                for script in ('crash_before_output.py',
+                               'crash_during_headers.py',
+                               'crash_after_output.py'):
+                    status, out, err = run(script)
+                    self.assertEqual(status, 1)
+                    self.assertIn(b'ValueError', out)
+                status, out, err = run('../cgi.py')
+                self.assertEqual(status, 127)
+                self.assertIn(b'No such script', err)
+                # A client that sends nothing does not hold up the others
+                with socket.socket(socket.AF_UNIX) as silent:
+                    silent.connect(address)
+                    start = time.monotonic()
+                    self.assertEqual(run('form.py', b'a=1')[0], 0)
+                    self.assertLess(time.monotonic() - start, 5)
+            finally:
+                server.terminate()
+                server.wait(10)
+                server.stdout.close()
+            self.assertFalse(os.path.exists(address))
+
+    def test_serve(self):
+        import http.client
+        import io
+        import threading
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        servers = []
+        started = threading.Event()
+
+        def ready(server):
+            servers.append(server)
+            started.set()
+
+        log = io.StringIO()
+        with unittest.mock.patch.dict(os.environ, {'PYTHONPATH': root}), \
+                unittest.mock.patch.object(cgi, 'sys', sys), \
+                contextlib.redirect_stderr(log):
+            thread = threading.Thread(
+                target=cgi.serve, args=(os.path.join(root, 'cgi-bin'),),
+                kwargs={'address': ('127.0.0.1', 0), 'max_children': 2,
+                        'ready': ready})
+            thread.start()
+            try:
+                self.assertTrue(started.wait(10))
+                port = servers[0].server_address[1]
+
+                def request(method, url, body=None, headers={}):
+                    conn = http.client.HTTPConnection('127.0.0.1', port,
+                                                      timeout=30)
+                    try:
+                        conn.request(method, url, body, headers)
+                        response = conn.getresponse()
+                        return response, response.read()
+                    finally:
+                        conn.close()
+
+                response, body = request('GET', '/cgi-bin/form.py?a=1')
+                self.assertEqual(response.status, 200)
+                self.assertEqual(response.getheader('Content-Type'),
+                                 'text/plain')
+                self.assertIn('spawn;dur=',
+                              response.getheader('Server-Timing'))
+                self.assertEqual(body, b'a: 1\n')
+                form = {'Content-Type': 'application/x-www-form-urlencoded'}
+                response, body = request('POST', '/cgi-bin/form.py?q=3',
+                                         b'a=1&b=2', form)
+                self.assertEqual(body, b'a: 1\nb: 2\nq: 3\n')
+                response, body = request('POST', '/cgi-bin/form.py',
+                                         iter([b'a=1', b'&b=', b'2']), form)
+                self.assertEqual(body, b'a: 1\nb: 2\n')
+                response, body = request('GET',
+                                         '/cgi-bin/crash_before_output.py')
+                self.assertEqual(response.status, 200)
+                self.assertIn(b'ValueError', body)
+                for url in ('/cgi-bin/missing.py', '/cgi-bin/../cgi.py',
+                            '/form.py'):
+                    response, body = request('GET', url)
+                    self.assertEqual(response.status, 404)
+            finally:
+                if servers:
+                    servers[0].shutdown()
+                thread.join(10)
+        self.assertIn('"POST /cgi-bin/form.py?q=3 HTTP/1.1" 200 exit=0',
+                      log.getvalue())
+
+    def test_serve_stalled_body(self):
+        import io
+        import threading
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        servers = []
+        started = threading.Event()
+
+        def ready(server):
+            servers.append(server)
+            started.set()
+
+        def request(port, head, body):
+            with socket.create_connection(('127.0.0.1', port),
+                                          timeout=30) as sock:
+                sock.sendall(head + body)
+                response = b''
+                while True:
+                    data = sock.recv(1 << 16)
+                    if not data:
+                        return response
+                    response += data
+
+        log = io.StringIO()
+        with unittest.mock.patch.dict(os.environ, {'PYTHONPATH': root}), \
+                unittest.mock.patch.object(cgi, 'sys', sys), \
+                contextlib.redirect_stderr(log):
+            thread = threading.Thread(
+                target=cgi.serve, args=(os.path.join(root, 'cgi-bin'),),
+                kwargs={'address': ('127.0.0.1', 0), 'max_children': 1,
+                        'queue_timeout': 1, 'timeout': 3, 'ready': ready})
+            thread.start()
+            try:
+                self.assertTrue(started.wait(10))
+                port = servers[0].server_address[1]
+                # The script exits without reading the body: the slot is
+                # free for the next request at once
+                response = request(port, b'GET /cgi-bin/form.py?a=1 '
+                                   b'HTTP/1.0\r\nContent-Length: 100\r\n\r\n',
+                                   b'x' * 10)
+                self.assertTrue(response.endswith(b'a: 1\n'))
+                response = request(port, b'GET /cgi-bin/form.py?b=2 '
+                                   b'HTTP/1.0\r\n\r\n', b'')
+                self.assertTrue(response.startswith(b'HTTP/1.0 200 '))
+                # The script reads the body: it gets the end of its input
+                # once the client has stalled for the timeout
+                start = time.monotonic()
+                response = request(port, b'POST /cgi-bin/form.py HTTP/1.0\r\n'
+                                   b'Content-Type: application/'
+                                   b'x-www-form-urlencoded\r\n'
+                                   b'Content-Length: 100\r\n\r\n', b'a=1')
+                self.assertTrue(response.startswith(b'HTTP/1.0 200 '))
+                self.assertLess(time.monotonic() - start, 20)
+            finally:
+                if servers:
+                    servers[0].shutdown()
+                thread.join(10)
+
+    def test_serve_not_executable(self):
+        import http.client
+        import io
+        import threading
+        servers = []
+        started = threading.Event()
+
+        def ready(server):
+            servers.append(server)
+            started.set()
+
+        log = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmp, \
+                contextlib.redirect_stderr(log):
+            script = os.path.join(tmp, 'script.sh')
+            with open(script, 'w') as f:
+                f.write('#!/bin/sh\necho\n')
+            os.chmod(script, 0o644)
+            thread = threading.Thread(
+                target=cgi.serve, args=(tmp,),
+                kwargs={'address': ('127.0.0.1', 0), 'max_children': 1,
+                        'queue_timeout': 5, 'ready': ready})
+            thread.start()
+            try:
+                self.assertTrue(started.wait(10))
+                port = servers[0].server_address[1]
+                for _ in range(2):
+                    conn = http.client.HTTPConnection('127.0.0.1', port,
+                                                      timeout=30)
+                    try:
+                        conn.request('GET', '/cgi-bin/script.sh')
+                        response = conn.getresponse()
+                        response.read()
+                    finally:
+                        conn.close()
+                    # The slot is released for the next request
+                    self.assertEqual(response.status, 500)
+            finally:
+                if servers:
+                    servers[0].shutdown()
+                thread.join(10)
+        self.assertIn('cannot run %s' % script, log.getvalue())
+
+    def test_loadtest(self):
+        for workload in ('get', 'urlencoded', 'multipart'):
+            environ, body = cgi._loadtest_request(workload, fields=3,
+                                                  field_size=5, files=2,
+                                                  file_size=100)
+            fs = cgi.FieldStorage(BytesIO(body), environ=environ)
+            self.assertEqual(fs.getvalue('field2'), 'vvvvv')
+            if workload == 'multipart':
+                self.assertEqual(len(fs['file1'].value), 100)
+        self.assertRaises(ValueError, cgi._loadtest_request, 'json')
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with unittest.mock.patch.dict(os.environ, {'PYTHONPATH': root}), \
+                unittest.mock.patch.object(cgi, 'sys', sys):
+            result = cgi.loadtest(os.path.join(root, 'cgi-bin', 'form.py'),
+                                  'multipart', requests=4, concurrency=2,
+                                  files=1)
+            self.assertEqual(result['requests'], 4)
+            self.assertEqual(result['exit_status'], {'0': 4})
+            self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+            self.assertLessEqual(result['p99_ms'], result['max_ms'])
+            self.assertGreater(result['output_bytes'], 0)
+            result = cgi.loadtest(
+                os.path.join(root, 'cgi-bin', 'crash_before_output.py'),
+                requests=2)
+            self.assertEqual(result['exit_status'], {'1': 2})
+
+    def test_load_script(self):
+        cache = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'script.py')
+            with open(path, 'w') as f:
+                f.write('x = 1')
+            code = cgi._load_script(cache, path)
+            self.assertIs(cgi._load_script(cache, path), code)
+            with open(path, 'w') as f:
+                f.write('x = 2')
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1000))
+            self.assertIsNot(cgi._load_script(cache, path), code)
+
+    def test_fieldstorage_close(self):
+        data = POSTDATA_W3.replace('...contents of file2.gif...',
+                                   'x' * 5000).encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY_W3),
+            'CONTENT_LENGTH': str(len(data))}
+        before = cgi.open_file_count()
+        with cgi.FieldStorage(BytesIO(data), environ=env) as fs:
+            self.assertIsNone(fs.file)
+            self.assertEqual(cgi.open_file_count(), before + 1)
+            nested = fs['files'].value
+        self.assertEqual(cgi.open_file_count(), before)
+        self.assertTrue(all(p.file.closed for p in nested))
+        self.assertTrue(fs['submit-name'].file.closed)
+        fs.close()
+
+    def test_parser_config(self):
+        config = cgi.ParserConfig(maxlen=600, encoding='latin-1',
+                                  keep_blank_values=True)
+        self.assertEqual(config.replace(maxlen=0).maxlen, 0)
+        self.assertEqual(config.maxlen, 600)
+        self.assertIn('maxlen=600', repr(config))
+
+        env = {}
+        self.assertEqual(cgi.parse(environ=env, config=config), {})
+        self.assertEqual(env, {})
+        env = {'REQUEST_METHOD': 'POST',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'CONTENT_LENGTH': '6'}
+        self.assertEqual(cgi.parse(BytesIO(b'a=&b=1'), env, config=config),
+                         {'a': [''], 'b': ['1']})
+        self.assertNotIn('QUERY_STRING', env)
+        with self.assertRaises(TypeError):
+            cgi.parse(environ=env, config=config)
+        with self.assertRaises(TypeError):
+            cgi.FieldStorage(environ=env, config=config)
+        env['CONTENT_LENGTH'] = '601'
+        with self.assertRaisesRegex(ValueError, 'Maximum content length'):
+            cgi.FieldStorage(BytesIO(b''), environ=env, config=config)
+
+        with unittest.mock.patch.object(cgi.sys, 'argv', ['x', 'c=3']):
+            fs = cgi.FieldStorage(environ={}, config=config)
+            self.assertEqual(fs.keys(), [])
+            self.assertEqual(cgi.FieldStorage(environ={}).getvalue('c'), '3')
+
+        made = []
+        def factory(part):
+            made.append(part.name)
+            return tempfile.TemporaryFile('wb+')
+        data = POSTDATA.replace('Testing 123.', 'x' * 2000).encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY),
+            'CONTENT_LENGTH': str(len(data))}
+        with cgi.FieldStorage(BytesIO(data), environ=env,
+                              config=cgi.ParserConfig(file_factory=factory)
+                              ) as fs:
+            self.assertEqual(made, ['file'])
+            self.assertEqual(fs['file'].value, b'x' * 2000 + b'\n')
+            self.assertEqual(fs['title'].value, '')
+        del made[:]
+        result = cgi.parse(BytesIO(data), env,
+                           config=cgi.ParserConfig(file_factory=factory))
+        self.assertEqual(made, ['file'])
+        self.assertEqual(result['file'], [b'x' * 2000 + b'\n'])
+        self.assertEqual(result['id'], ['1234'])
+        self.assertNotIn('QUERY_STRING', env)
+
+        # The per-parse settings come from the config, shared by the parts
+        import hashlib
+        calls = []
+        config = cgi.ParserConfig(digests=[hashlib.sha256],
+                                  progress=lambda *args: calls.append(args),
+                                  pipeline_depth=2)
+        with cgi.FieldStorage(BytesIO(data), environ=env,
+                              config=config) as fs:
+            self.assertIs(fs['file'].config, config)
+            self.assertEqual(fs['file'].digests['sha256'], hashlib.sha256(
+                b'x' * 2000 + b'\n').hexdigest())
+        self.assertTrue(calls[-1][-1])
+        with cgi.FieldStorage(BytesIO(data), environ=env) as fs:
+            self.assertIs(fs['file'].config, fs.config)
+        # ... and no module global is used
+        recorder = unittest.mock.Mock(metrics=cgi.ParseMetrics())
+        with unittest.mock.patch.object(cgi, '_recorder', recorder):
+            self.assertIsNone(cgi.FieldStorage(BytesIO(data), environ=env,
+                                               config=config).metrics)
+            self.assertIs(cgi.FieldStorage(BytesIO(data), environ=env
+                                           ).metrics, recorder.metrics)
+        env = {'REQUEST_METHOD': 'POST', 'HTTP_TRANSFER_ENCODING': 'chunked',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded'}
+        data = b'3;ext=abcdefgh\r\na=1\r\n0\r\n\r\n'
+        self.assertEqual(cgi.parse(BytesIO(data), env, config=config),
+                         {'a': ['1']})
+        with self.assertRaisesRegex(ValueError, 'line too long'):
+            cgi.parse(BytesIO(data), env,
+                      config=config.replace(max_chunk_line=8))
+
+    def test_parser_config_conflicts(self):
+        env = {'REQUEST_METHOD': 'POST',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'CONTENT_LENGTH': '6'}
+        config = cgi.ParserConfig(keep_blank_values=True)
+        self.assertEqual(cgi.parse(BytesIO(b'a=&b=1'), env, True,
+                                   config=config), {'a': [''], 'b': ['1']})
+        for kwargs in ({'strict_parsing': True}, {'separator': ';'},
+                       {'max_decompressed_size': 5}):
+            with self.assertRaisesRegex(TypeError, 'conflicts'):
+                cgi.parse(BytesIO(b'a=&b=1'), env, config=config, **kwargs)
+        for kwargs in ({'encoding': 'latin-1'}, {'errors': 'strict'},
+                       {'max_num_fields': 1}, {'read_timeout': 1},
+                       {'input_buffer_size': 4096}, {'metrics': True},
+                       {'pipeline_depth': 2}, {'verify_content_md5': True},
+                       {'progress': print}, {'progress_bytes': 10}):
+            with self.assertRaisesRegex(TypeError, 'conflicts'):
+                cgi.FieldStorage(BytesIO(b'a=&b=1'), environ=env,
+                                 config=config, **kwargs)
+        fs = cgi.FieldStorage(BytesIO(b'a=&b=1'), environ=env,
+                              encoding='utf-8', config=config)
+        self.assertEqual(fs.getvalue('a'), '')
+
+        metrics = cgi.ParseMetrics()
+        config = cgi.ParserConfig(input_buffer_size=4096, metrics=True)
+        fs = cgi.FieldStorage(BytesIO(b'a=&b=1'), environ=env, config=config)
+        self.assertEqual(fs.input_stats['bytes'], 6)
+        self.assertEqual(fs.metrics.bytes_read, 6)
+        fs = cgi.FieldStorage(BytesIO(b'a=&b=1'), environ=env, config=config,
+                              metrics=metrics)
+        self.assertIs(fs.metrics, metrics)
+
+        environ = dict(env, CONTENT_LENGTH='3',
+                       **{'wsgi.input': BytesIO(b'a=\xe9')})
+        fs = cgi.FieldStorage.from_wsgi(environ, encoding='latin-1',
+                                        metrics=True)
+        self.assertEqual(fs.getvalue('a'), '\xe9')
+        self.assertEqual(fs.metrics.bytes_read, 3)
+
+    def test_parser_config_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        configs = [cgi.ParserConfig(separator=sep) for sep in '&;']
+        def work(i):
+            config = configs[i % 2]
+            env = {'QUERY_STRING': 'a=%d%sb=2' % (i, config.separator)}
+            return cgi.parse(environ=env, config=config), env
+        with ThreadPoolExecutor(4) as executor:
+            for i, (result, env) in enumerate(executor.map(work, range(200))):
+                self.assertEqual(result, {'a': [str(i)], 'b': ['2']})
+                self.assertEqual(list(env), ['QUERY_STRING'])
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+    def test_send_fd(self):
+        data = POSTDATA.replace('Testing 123.', 'x' * 2000).encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY),
+            'CONTENT_LENGTH': str(len(data))}
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        with cgi.FieldStorage(BytesIO(data), environ=env) as fs:
+            fs['file'].send_fd(a, {'request': 7})
+            fs['id'].send_fd(a)
+            with self.assertRaises(ValueError):
+                fs.send_fd(a)
+        meta, f = cgi.recv_fd(b)
+        with f:
+            self.assertEqual(f.read(), b'x' * 2000 + b'\n')
+        self.assertEqual(meta['name'], 'file')
+        self.assertEqual(meta['filename'], 'test.txt')
+        self.assertEqual(meta['type'], 'text/plain')
+        self.assertEqual(meta['size'], 2001)
+        self.assertTrue(meta['binary'])
+        self.assertEqual(meta['request'], 7)
+        meta, f = cgi.recv_fd(b)
+        with f:
+            self.assertEqual(f.read(), b'1234')
+        self.assertEqual(meta['name'], 'id')
+
+        # Reads on either side do not move the other side's offset
+        with cgi.FieldStorage(BytesIO(data), environ=env) as fs:
+            part = fs['file']
+            part.send_fd(a)
+            part.send_fd(a)
+            # Without /proc, the file is read with os.pread()
+            for no_proc in (False, True):
+                with unittest.mock.patch.object(
+                        cgi.os, 'open', side_effect=OSError) if no_proc \
+                        else contextlib.nullcontext():
+                    meta, f = cgi.recv_fd(b)
+                with f:
+                    self.assertEqual(f.read(10), b'x' * 10)
+                    part.file.seek(500)
+                    self.assertEqual(f.read(5), b'x' * 5)
+                    self.assertEqual(part.file.read(3), b'xxx')
+                    self.assertEqual(part.file.tell(), 503)
+                    f.seek(0)
+                    self.assertEqual(len(f.read()), 2001)
+                    self.assertEqual(part.file.tell(), 503)
+
+    def test_raw_input_lines(self):
+        data = b'a\r\nbb\n' + b'x' * 100000 + b'\n\nend'
+        for fp in (BytesIO(), tempfile.TemporaryFile()):
+            fp.write(data)
+            fp.seek(0)
+            reader = cgi._RawInput(fp, len(data) - 1, 16)
+            ref = BytesIO(data[:-1])
+            for size in (-1, 1, 5, 200000, 3, -1, 0):
+                self.assertEqual(reader.readline(size), ref.readline(size))
+            self.assertEqual(reader.read(10), ref.read(10))
+            self.assertEqual(reader.read(), ref.read())
+            self.assertEqual(reader.read(), b'')
+            self.assertEqual(reader.bytes, len(data) - 1)
+            fp.close()
+
+    def test_fieldstorage_input_buffer(self):
+        data = POSTDATA_W3.encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY_W3),
+            'CONTENT_LENGTH': str(len(data))}
+        r, w = os.pipe()
+        os.write(w, data + b'more')
+        os.close(w)
+        with open(r, 'rb') as fp:
+            fs = cgi.FieldStorage(fp, environ=env, input_buffer_size=1 << 20,
+                                  read_timeout=5)
+            self.assertEqual(fp.read(), b'more')
+        self.assertEqual(fs.input_stats, {'reads': 1, 'bytes': len(data)})
+        self.assertEqual(fs['files'].value[1].value,
+                         b'...contents of file2.gif...')
+        fs = cgi.FieldStorage(BytesIO(data), environ=env, input_buffer_size=7)
+        self.assertEqual(fs.input_stats['bytes'], len(data))
+        self.assertEqual(fs['submit-name'].value, 'Larry')
+
+    def test_open_file_count_threads(self):
+        # Files are tracked and counted safely while threads parse forms
+        from concurrent.futures import ThreadPoolExecutor
+        data = POSTDATA_W3.replace('...contents of file2.gif...',
+                                   'x' * 5000).encode('latin-1')
+        env = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary={}'.format(BOUNDARY_W3),
+            'CONTENT_LENGTH': str(len(data))}
+        before = cgi.open_file_count()
+
+        def parse(_):
+            with cgi.FieldStorage(BytesIO(data), environ=env) as fs:
+                return fs['submit-name'].value
+
+        def count(_):
+            return cgi.open_file_count()
+
+        with ThreadPoolExecutor(8) as executor:
+            parses = [executor.submit(parse, i) for i in range(200)]
+            for n in executor.map(count, range(2000)):
+                self.assertGreaterEqual(n, 0)
+            self.assertEqual({f.result() for f in parses}, {'Larry'})
+        self.assertEqual(cgi.open_file_count(), before)
+
+    def test_lazy_imports(self):
+        # A plain GET must not pay for the email package or tempfile
+        code = ("import sys, io, cgi\n"
+                "fs = cgi.FieldStorage(io.BytesIO(), environ={\n"
+                "    'REQUEST_METHOD': 'GET', 'QUERY_STRING': 'a=1&b=2'})\n"
+                "assert fs.getfirst('b') == '2'\n"
+                "print(' '.join(m for m in sys.modules\n"
+                "               if m.split('.')[0] in ('email', 'tempfile')))\n")
+        out = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(out.stdout.strip(), b'')
+        # The names that used to be imported at module level still resolve
+        self.assertIs(cgi.Message, email.message.Message)
+        self.assertIs(cgi.urllib.parse, urllib.parse)
+        self.assertTrue(cgi.valid_boundary(b'abc'))
+        self.assertTrue(cgi.valid_boundary('abc'))
+        self.assertFalse(cgi.valid_boundary('abc '))
+        with self.assertRaises(AttributeError):
+            cgi.no_such_name
+
+    def test_upload_peak_memory(self):
+        # Streaming an upload to its file keeps peak memory bounded,
+        # however large the body is.
+        lines = (b'x' * 63 + b'\n', bytes(range(14, 256)) * 4)
+        with _upload_body(0, lines[0]) as (fp, env):
+            cgi.FieldStorage(fp, environ=env)      # import what parsing needs
+        for line in lines:
+            for size in (1 << 20, 16 << 20):
+                with _upload_body(size, line) as (fp, env):
+                    tracemalloc.start()
+                    try:
+                        form = cgi.FieldStorage(fp, environ=env)
+                        peak = tracemalloc.get_traced_memory()[1]
+                    finally:
+                        tracemalloc.stop()
+                    with form:
+                        self.assertGreater(form['upload'].file.seek(0, 2),
+                                           size - len(line) * 1024)
+                    self.assertLess(peak, 1 << 20)
+
+    def test_stream_peak_memory(self):
+        # The other streaming paths keep peak memory bounded too: a
+        # non-form body, chunked and gzip bodies, and parse_records().
+        import gzip
+
+        def single(fp, env):
+            # Read to EOF by read_lines(), which the body of a PUT without
+            # a content length goes through
+            env = dict(env, REQUEST_METHOD='PUT')
+            del env['CONTENT_TYPE'], env['CONTENT_LENGTH']
+            return env, fp
+
+        def chunked(fp, env):
+            out = tempfile.TemporaryFile()
+            while True:
+                data = fp.read(1 << 16)
+                if not data:
+                    break
+                out.write(b'%x\r\n%s\r\n' % (len(data), data))
+            out.write(b'0\r\n\r\n')
+            out.seek(0)
+            env = dict(env, HTTP_TRANSFER_ENCODING='chunked')
+            del env['CONTENT_LENGTH']
+            return env, out
+
+        def gzipped(fp, env):
+            out = tempfile.TemporaryFile()
+            with gzip.GzipFile(fileobj=out, mode='wb') as z:
+                shutil.copyfileobj(fp, z)
+            env = dict(env, HTTP_CONTENT_ENCODING='gzip',
+                       CONTENT_LENGTH=str(out.tell()))
+            out.seek(0)
+            return env, out
+
+        def parse(fp, env):
+            form = cgi.FieldStorage(fp, environ=env, max_compression_ratio=0)
+            with form:
+                if form.list is None:
+                    return form.file.seek(0, 2)
+                return form['upload'].file.seek(0, 2)
+
+        def records(fp, env):
+            return sum(len(record[0])
+                       for record in cgi.parse_records(fp, env))
+
+        def ndjson(fp, env):
+            out = tempfile.TemporaryFile()
+            line = b'["%s"]\n' % (b'x' * 60)
+            for _ in range(int(env['CONTENT_LENGTH']) // len(line)):
+                out.write(line)
+            env = {'CONTENT_TYPE': 'application/x-ndjson',
+                   'CONTENT_LENGTH': str(out.tell())}
+            out.seek(0)
+            return env, out
+
+        line = b'x' * 63 + b'\n'
+        for name, make, run in (('single', single, parse),
+                                ('chunked', chunked, parse),
+                                ('gzip', gzipped, parse),
+                                ('records', ndjson, records)):
+            with self.subTest(name):
+                with _upload_body(0, line) as (fp, env):
+                    env, body = make(fp, env)
+                    with body:
+                        run(body, env)      # import what parsing needs
+                for size in (1 << 20, 8 << 20):
+                    with _upload_body(size, line) as (fp, env):
+                        env, body = make(fp, env)
+                        with body:
+                            tracemalloc.start()
+                            try:
+                                result = run(body, env)
+                                peak = tracemalloc.get_traced_memory()[1]
+                            finally:
+                                tracemalloc.stop()
+                    self.assertGreater(result, size // 2)
+                    self.assertLess(peak, 1 << 20)
+
+    @unittest.skipUnless(resource, 'requires the resource module')
+    def test_upload_max_rss(self):
+        code = ("import resource, sys, cgi\n"
+                "with open(sys.argv[1], 'rb') as fp:\n"
+                "    form = cgi.FieldStorage(fp, environ={\n"
+                "        'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': sys.argv[2],\n"
+                "        'CONTENT_TYPE': 'multipart/form-data; boundary=B'})\n"
+                "    form['upload'].file.close()\n"
+                "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n")
+        rss = []
+        for size in (1 << 20, 64 << 20):
+            with _upload_body(size, b'x' * 63 + b'\n') as (fp, env), \
+                    tempfile.NamedTemporaryFile() as body:
+                shutil.copyfileobj(fp, body)
+                body.flush()
+                out = subprocess.run(
+                    [sys.executable, '-c', code, body.name,
+                     env['CONTENT_LENGTH']], capture_output=True, check=True,
+                    cwd=os.path.dirname(os.path.dirname(
+                        os.path.abspath(__file__))))
+                rss.append(int(out.stdout))
+        if sys.platform == 'darwin':
+            rss = [n // 1024 for n in rss]      # bytes, not KiB
+        # 63 MiB more body must cost well under 16 MiB more memory
+        self.assertLess(rss[1] - rss[0], 16 << 10)
+
     _qs_result = {
         'key1': 'value1',
         'key2': ['value2x', 'value2y'],